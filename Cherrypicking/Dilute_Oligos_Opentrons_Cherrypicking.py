@@ -1,6 +1,10 @@
+import collections
 import csv 
+import hashlib
+import json
+import math
 import os
-import pandas as pd
+import time
 
 metadata = {
     'protocolName': 'Dilute Primers in 384well and 96-well plate',
@@ -10,68 +14,603 @@ metadata = {
     }
 
 
+def get_values(*names):
+
+    dict1 = dict()
+
+    dict1["multi_dispense"] = True  # Aspirate once from the reservoir and dispense to several wells
+    dict1["disposal_volume"] = 20   # Extra water kept in the tip on every multi-dispense and returned to the reservoir
+    # A p20_single_gen2 on the left mount takes the water volumes it suits from the p300, None uses the p300 only
+    dict1["left_pipette"] = None
+    dict1["left_tiprack_slots"] = ["1"]
+    dict1["left_disposal_volume"] = 2  # Disposal volume of the left pipette's multi-dispense
+    dict1["well_order"] = "serpentine"  # picklist, serpentine or nearest
+    dict1["working_directory"] = "/data/user_storage"  # Copy the picklists here in Opentrons through SSH
+    dict1["allow_duplicate_destinations"] = False  # True accepts several picklist rows for the same well
+    dict1["timing_log"] = "/data/user_storage/timing_log.jsonl"  # JSON lines timing of real runs, None turns it off
+    # Labware definitions built by Simulation/labware_cache.py, None loads the labware from the robot's own library
+    dict1["labware_cache"] = None
+    # Progress of a real run, a restarted run with the same picklists skips the wells already done. None turns it off.
+    dict1["checkpoint"] = "/data/user_storage/dilute_oligos_checkpoint.json"
+    # ml of water filled into the reservoir, checked against all picklists before the run. Fill exactly this volume:
+    # the tip follows the water level worked out from it
+    dict1["water_volume"] = 200
+    # Plates to dilute: label -> (picklist in working_directory, labware, deck slot). All plates are diluted in one
+    # pass with one tip, the multi-dispense runs carry on from one plate to the next.
+    dict1["oligo_plates"] = {
+        "Oligos_1": ("Picklist_Oligos_1.csv", "usascientific_96_wellplate_2.4ml_deep", "5"),
+        "Oligos_2": ("Picklist_Oligos_2.csv", "corning_384_wellplate_112ul_flat", "6"),
+    }
+
+    _all_values = dict1
+
+    return [_all_values[n] for n in names]
+
+
+def read_labware_cache(filename):
+
+    # Labware definitions by load name from the cache Simulation/labware_cache.py builds, the latest version of
+    # each. Without the file every labware comes from the robot's labware library as usual.
+    if not filename or not os.path.exists(filename):
+        return dict()
+    with open(filename) as cache_file:
+        entries = sorted(json.load(cache_file)["labware"].values(), key=lambda entry: entry["version"])
+    return dict((entry["definition"]["parameters"]["loadName"], entry["definition"]) for entry in entries)
+
+
+def load_labware(parent, cache, load_name, location=None, label=None):
+
+    # Load labware on the deck, or on a module when `parent` is a module and there is no location,
+    # from its cached definition when the cache has one
+    definition = cache.get(load_name)
+    if location is None:
+        if definition:
+            return parent.load_labware_from_definition(definition, label)
+        return parent.load_labware(load_name, label)
+    if definition:
+        return parent.load_labware_from_definition(definition, location, label)
+    return parent.load_labware(load_name, location, label)
+
+
+PicklistRow = collections.namedtuple("PicklistRow", ["well", "volume", "source_well"])
+
+
+def read_picklist(filename, columns):
+
+    # Stream the picklist CSV as PicklistRow records using the csv module only, so pandas
+    # does not have to be imported on the robot. `columns` are the headers the picklist must have.
+    # "Volume" and "Source Well" are optional and come back as None when the picklist has no such column.
+
+    with open(filename, newline='', encoding='utf-8-sig') as picklist_file:
+        reader = csv.DictReader(picklist_file)
+        missing = [column for column in columns if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(filename + ' is missing the column(s): ' + ', '.join(missing))
+
+        for line in reader:
+            volume = line.get("Volume")
+            source_well = line.get("Source Well")
+            yield PicklistRow(line["Destination Well"].strip(),
+                              float(volume) if volume else None,
+                              source_well.strip() if source_well else None)
+
+
+def validate_picklist(filename, picklist, dest_labware, source_labware=None, pipette=None, allow_duplicates=False):
+
+    # Check the rows against the labware they are pipetted into and from before anything moves:
+    # every well exists, every volume fits into its well and no well is a destination twice.
+    # Returns the rows below the minimum volume of the pipette.
+    problems = []
+    small = []
+    dest_wells = dest_labware.wells_by_name()
+    seen = set()
+
+    for line, row in enumerate(picklist, 2):
+        if row.well not in dest_wells:
+            problems.append('line ' + str(line) + ': no well ' + row.well + ' on ' + dest_labware.load_name)
+        elif row.volume is not None and row.volume > dest_wells[row.well].max_volume:
+            problems.append('line ' + str(line) + ': ' + str(row.volume) + ' ul do not fit into ' + row.well)
+        if source_labware is not None and row.source_well not in source_labware.wells_by_name():
+            problems.append('line ' + str(line) + ': no source well ' + str(row.source_well) + ' on ' + source_labware.load_name)
+        if pipette is not None and row.volume is not None and row.volume < pipette.min_volume:
+            small.append('line ' + str(line) + ': ' + str(row.volume) + ' ul')
+        if row.well in seen and not allow_duplicates:
+            problems.append('line ' + str(line) + ': ' + row.well + ' is a destination more than once')
+        seen.add(row.well)
+
+    if problems:
+        raise ValueError(filename + ' has ' + str(len(problems)) + ' problem(s): ' + '; '.join(problems[:10]))
+    return small
+
+
+def load_picklist(protocol_context, filename, columns, dest_labware, source_labware=None, pipette=None,
+                  allow_duplicates=False):
+
+    # Read and validate a picklist. Volumes below the minimum of the pipette are still transferred,
+    # the run only warns about them
+    picklist = list(read_picklist(filename, columns))
+    small = validate_picklist(filename, picklist, dest_labware, source_labware, pipette, allow_duplicates)
+    if small:
+        message = ('Warning: ' + str(len(small)) + ' row(s) of ' + os.path.basename(filename) + ' are below the ' +
+                   str(pipette.min_volume) + ' ul minimum of ' + pipette.name + ': ' + '; '.join(small[:10]))
+        if pipette.name != 'p20_single_gen2':
+            message += '. Set left_pipette = "p20_single_gen2" to pipette them accurately'
+        protocol_context.comment(message)
+    return picklist
+
+
+def well_locations(labware, position, offset):
+
+    # Map every well name of the labware to one location in that well, e.g. top(-6).
+    # Built once per labware so the loops don't rebuild wells_by_name() for every picklist row.
+    return dict((name, getattr(well, position)(offset)) for name, well in labware.wells_by_name().items())
+
+
+def xy(location):
+    return (location.point.x, location.point.y)
+
+
+def travel_distance(points, start):
+
+    # Estimated XY travel in mm when the gantry starts at `start` and visits each
+    # (first, last) point pair of `points` in order
+    distance = 0
+    position = start
+    for first, last in points:
+        distance = distance + math.hypot(first[0] - position[0], first[1] - position[1])
+        distance = distance + math.hypot(last[0] - first[0], last[1] - first[1])
+        position = last
+    return distance
+
+
+def order_picklist(protocol_context, picklist, locate, start, mode):
+
+    # Reorder picklist rows to shorten gantry travel before they are pipetted.
+    # locate(row) returns the XY of the first and last well a row visits.
+    # mode: "picklist" keeps the CSV order, "serpentine" walks the plate column by column
+    # alternating down and up, "nearest" always moves to the closest remaining well.
+    # The picklist order is kept unless the reordered rows travel less.
+
+    points = [locate(row) for row in picklist]
+    order = list(range(len(picklist)))
+
+    if mode == "serpentine":
+        columns = sorted(set(round(first[0], 1) for first, last in points))
+        column_index = dict((x, i) for i, x in enumerate(columns))
+
+        def serpentine_key(i):
+            x, y = points[i][0]
+            column = column_index[round(x, 1)]
+            return (column, y if column % 2 else -y)
+
+        order.sort(key=serpentine_key)
+
+    elif mode == "nearest":
+        remaining = order
+        order = []
+        position = start
+        while remaining:
+            i = min(remaining, key=lambda j: math.hypot(points[j][0][0] - position[0], points[j][0][1] - position[1]))
+            remaining.remove(i)
+            order.append(i)
+            position = points[i][1]
+
+    elif mode != "picklist":
+        raise ValueError('Unknown well order "' + str(mode) + '", use picklist, serpentine or nearest')
+
+    before = travel_distance(points, start)
+    after = travel_distance([points[i] for i in order], start)
+    kept = mode != "picklist" and after >= before
+    protocol_context.comment('Estimated XY travel: ' + str(round(before)) + ' mm in picklist order, ' +
+                             str(round(after)) + ' mm in ' + mode + ' order' +
+                             (', the picklist order is kept' if kept else ''))
+    if kept:
+        return list(picklist)
+
+    return [picklist[i] for i in order]
+
+
+def plan_multi_dispense(doses, max_volume, disposal_volume):
+
+    # Group consecutive (destination, volume, step) doses into aspirate-once/dispense-many runs.
+    # A run holds at most (max_volume - disposal_volume) of water, a well that needs more
+    # than that is split into equal parts which are packed like any other dose.
+    # Returns the runs as lists of (destination, volume, step), the parts of a dose share its step,
+    # and the number of reservoir trips the one-transfer-per-row loop would have taken.
+
+    capacity = max_volume - disposal_volume
+    runs = []
+    current = []
+    loaded = 0
+    single_trips = 0
+
+    for destination, volume, step in doses:
+        single_trips = single_trips + math.ceil(volume / max_volume)
+        parts = math.ceil(volume / capacity)
+
+        for i in range(parts):
+            part = volume / parts
+            if current and loaded + part > capacity:
+                runs.append(current)
+                current = []
+                loaded = 0
+            current.append((destination, part, step))
+            loaded = loaded + part
+
+    if current:
+        runs.append(current)
+
+    return runs, single_trips
+
+
+# Reservoirs the water is taken from: inner area of the well in mm2, capacity in ul and the dead volume in ul
+# that stays behind once the tip reaches its lowest aspiration height
+RESERVOIRS = {
+    "agilent_1_reservoir_290ml": (108.0 * 72.0, 290000, 10000),
+}
+
+
+class LiquidTracker:
+
+    # Keeps the remaining volume of every reservoir well and aspirates a few mm below the liquid surface,
+    # so the tip follows the level down instead of dipping to a fixed height. plan() adds up what the run
+    # will take from a well and check() rejects the run before it starts when a well would run dry.
+
+    def __init__(self, protocol_context, immersion=3):
+        self._protocol_context = protocol_context
+        self._immersion = immersion
+        self.wells = dict()
+        self.restored = False
+
+    def add(self, name, well, load_name, volume_ml, min_height):
+        area, capacity, dead_volume = RESERVOIRS[load_name]
+        volume = volume_ml * 1000
+        if volume > capacity:
+            raise ValueError(str(volume_ml) + ' ml of ' + name + ' do not fit into ' + load_name)
+        self.wells[name] = dict(well=well, area=area, volume=volume, dead_volume=dead_volume,
+                                min_height=min_height, needed=0)
+
+    def plan(self, name, volume, channels=1):
+        self.wells[name]["needed"] += volume * channels
+
+    def check(self):
+        short = []
+        for name, liquid in self.wells.items():
+            needed = liquid["needed"] + liquid["dead_volume"]
+            self._protocol_context.comment(name + ': ' + str(math.ceil(needed / 100) / 10) + ' ml needed, ' +
+                                           str(liquid["volume"] / 1000) + ' ml loaded')
+            if liquid["needed"] and needed > liquid["volume"]:
+                short.append(name + ' (' + str(math.ceil(needed / 100) / 10) + ' ml)')
+        if short:
+            raise ValueError('Not enough liquid for this run: ' + ', '.join(short))
+
+    def fill_message(self):
+        # The volumes the operator fills in. The aspiration heights are worked out from them, a well filled with
+        # less than its volume would have the tip aspirate above the liquid. A resumed run goes on from the volumes
+        # an earlier run left, so nothing is refilled.
+        preposition = ' in ' if self.restored else ' into '
+        volumes = ', '.join(str(liquid["volume"] / 1000) + ' ml ' + name + preposition + str(liquid["well"])
+                            for name, liquid in self.wells.items() if liquid["needed"])
+        if self.restored:
+            return 'Leave the reservoirs as they are, the run goes on from ' + volumes + ', then resume'
+        return 'Fill exactly ' + volumes + ', then resume'
+
+    def volumes(self):
+        return dict((name, liquid["volume"]) for name, liquid in self.wells.items())
+
+    def restore(self, volumes):
+        # Go on from the volumes an earlier run saved
+        for name, volume in volumes.items():
+            self.wells[name]["volume"] = volume
+        self.restored = True
+
+    def location(self, name, volume=0):
+        # Aspiration height in the well once `volume` ul have been taken out, never below min_height
+        liquid = self.wells[name]
+        height = (liquid["volume"] - volume) / liquid["area"] - self._immersion
+        return liquid["well"].bottom(max(height, liquid["min_height"]))
+
+    def aspirate_from(self, name, volume, channels=1):
+        # Location to aspirate `volume` per channel, the volume is taken off the well
+        location = self.location(name, volume * channels)
+        self.wells[name]["volume"] -= volume * channels
+        return location
+
+
+def route_rows(rows, pipettes, volume):
+
+    # Send every row to the smallest pipette that takes its volume, `volume(row)`, in one aspiration.
+    # Rows no pipette takes in one go go to the largest one, which splits them. Returns (pipette, rows)
+    # batches in the order of `pipettes`, so each pipette handles all its rows before the next one starts.
+    by_size = sorted(pipettes, key=lambda pipette: pipette.max_volume)
+    batches = [(pipette, []) for pipette in pipettes]
+    for row in rows:
+        fitting = [pipette for pipette in by_size if pipette.min_volume <= volume(row) <= pipette.max_volume]
+        pipette = fitting[0] if fitting else by_size[-1]
+        batches[pipettes.index(pipette)][1].append(row)
+    return [(pipette, pipette_rows) for pipette, pipette_rows in batches if pipette_rows]
+
+
+def add_water(protocol_context, pipette, doses, dest_locations, liquids, multi_dispense, disposal_volume, checkpoint):
+
+    # Add water from the top of each well, the tip is not changed in between. `doses` are (destination, volume, step)
+    # triples in the order they are dispensed and `dest_locations` maps every destination to its location.
+    # The water is taken from the "water" well of `liquids` just below its surface. The step of a dose is
+    # recorded in `checkpoint` as soon as all of its water is dispensed, a restart after an abort between
+    # the parts of a split dose adds all of its water again.
+    source_well = liquids.wells["water"]["well"]
+
+    if not multi_dispense:
+        for destination, volume, step in doses:
+            pipette.transfer(volume, liquids.aspirate_from("water", volume), dest_locations[destination], new_tip = 'never')
+            checkpoint.complete(step)
+        return
+
+    runs, single_trips = plan_multi_dispense(doses, pipette.max_volume, disposal_volume)
+    parts = collections.Counter(step for run in runs for destination, volume, step in run)
+
+    for run in runs:
+        # The disposal volume goes back to the reservoir, so only the dispensed water is taken off
+        volume = sum(volume for destination, volume, step in run)
+        pipette.aspirate(volume + disposal_volume, liquids.aspirate_from("water", volume))
+        for destination, volume, step in run:
+            pipette.dispense(volume, dest_locations[destination])
+            parts[step] = parts[step] - 1
+            if not parts[step]:
+                checkpoint.complete(step)
+        pipette.blow_out(source_well.top())  # Return the disposal volume to the reservoir
+
+    protocol_context.comment('Reservoir trips: ' + str(len(runs)) + ' instead of ' + str(single_trips) +
+                             ' (' + str(single_trips - len(runs)) + ' saved)')
+
+
+# Positions of the volume and location arguments of the pipette calls the step log records
+LOGGED_CALLS = {
+    "aspirate": (0, 1), "dispense": (0, 1), "mix": (1, 2), "transfer": (0, 2), "air_gap": (0, None),
+    "blow_out": (None, 0), "touch_tip": (None, 0), "pick_up_tip": (None, 0), "return_tip": (None, None),
+    "drop_tip": (None, 0),
+}
+
+
+def describe_location(location):
+    # "A1 of reagent reservoir on 7" for a well or a location in a well
+    target = getattr(location, "labware", location)
+    return str(getattr(target, "object", target))
+
+
+class StepLog:
+
+    # Timing log of a real run: every phase and every liquid handling call of a wrapped pipette becomes one
+    # JSON line with its phase, well, action, volume and start and end time. Each line is appended to the
+    # log file as soon as it is logged, so a run that is stopped keeps its log up to the last call.
+    # Nothing is logged while the protocol is simulated or analyzed.
+
+    def __init__(self, protocol_context, filename):
+        self.enabled = filename is not None and not protocol_context.is_simulating()
+        self._filename = filename
+        self._run = time.strftime("%Y%m%d-%H%M%S")
+        self._phase = "setup"
+        self._phase_start = time.time()
+
+    def phase(self, name):
+        # End the current phase and start phase `name`
+        if not self.enabled:
+            return
+        now = time.time()
+        self._add({"event": "phase", "phase": self._phase, "start": self._phase_start, "end": now})
+        self._phase = name
+        self._phase_start = now
+
+    def step(self, action, start, end, location=None, volume=None):
+        self._add({"event": "step", "phase": self._phase, "action": action, "start": start, "end": end,
+                   "well": describe_location(location) if location is not None else None, "volume": volume})
+
+    def wrap(self, pipette):
+        # The pipette itself when nothing is logged, otherwise a stand-in that logs its liquid handling calls
+        return LoggedPipette(pipette, self) if self.enabled else pipette
+
+    def _add(self, event):
+        event["run"] = self._run
+        with open(self._filename, "a") as log_file:
+            log_file.write(json.dumps(event) + "\n")
+
+    def close(self):
+        self.phase("end")
+
+
+class LoggedPipette:
+
+    # Forwards everything to the pipette and reports the calls in LOGGED_CALLS to the step log
+
+    def __init__(self, pipette, log):
+        object.__setattr__(self, "_pipette", pipette)
+        object.__setattr__(self, "_log", log)
+
+    def __setattr__(self, name, value):
+        setattr(self._pipette, name, value)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._pipette, name)
+        if name not in LOGGED_CALLS:
+            return attribute
+
+        volume_index, location_index = LOGGED_CALLS[name]
+
+        def logged(*args, **kwargs):
+            start = time.time()
+            result = attribute(*args, **kwargs)
+            volume = args[volume_index] if volume_index is not None and len(args) > volume_index else kwargs.get("volume")
+            location = args[location_index] if location_index is not None and len(args) > location_index else kwargs.get("location")
+            self._log.step(name, start, time.time(), location, volume)
+            return result
+
+        return logged
+
+
+class Checkpoint:
+
+    # Progress of a real run in a JSON file: the steps that are done (picklist rows, columns or phases), the
+    # number of tips taken from the racks of each mount and the volumes left in the reservoirs. The file is
+    # rewritten after every completed step.
+    # A run with the same settings that starts while the file is there skips the steps that are done and
+    # starts every pipette at its first unused tip; the file is removed when the run finishes.
+    # Nothing is read or written while the protocol is simulated or analyzed.
+
+    def __init__(self, protocol_context, filename, key):
+        self.enabled = filename is not None and not protocol_context.is_simulating()
+        self._filename = filename
+        self._key = key
+        self._done = set()
+        self._tips = dict()
+        self._volumes = None
+        self._liquids = None
+        if self.enabled and os.path.exists(filename):
+            with open(filename) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if state["key"] == key:
+                self._done = set(state["done"])
+                self._tips = state["tips"]
+                self._volumes = state.get("volumes")
+                protocol_context.comment('Resuming from ' + filename + ': ' + str(len(self._done)) + ' steps are done')
+
+    def __contains__(self, step):
+        return step in self._done
+
+    def complete(self, step):
+        self._done.add(step)
+        self._save()
+
+    def took_tip(self, pipette, count=1):
+        # Record the tips `pipette` is about to pick up, so a restart never goes back to a taken tip
+        self._tips[pipette.mount] = self._tips.get(pipette.mount, 0) + count
+        self._save()
+
+    def tips_taken(self, pipette):
+        return self._tips.get(pipette.mount, 0)
+
+    def resume_tips(self, pipette):
+        # Start `pipette` at the first tip of its racks the earlier runs did not take
+        used = self.tips_taken(pipette)
+        if used:
+            if pipette.channels == 8:
+                tips = [column[0] for rack in pipette.tip_racks for column in rack.columns()]
+            else:
+                tips = [well for rack in pipette.tip_racks for well in rack.wells()]
+            if used >= len(tips):
+                raise ValueError('All tips of the ' + pipette.name + ' were used, refill its tip racks and remove ' + self._filename)
+            pipette.starting_tip = tips[used]
+
+    def _save(self):
+        if not self.enabled:
+            return
+        # Written next to the checkpoint and renamed, so an abort never leaves half a file behind
+        volumes = self._liquids.volumes() if self._liquids else None
+        with open(self._filename + ".tmp", "w") as checkpoint_file:
+            json.dump({"key": self._key, "done": sorted(self._done), "tips": self._tips, "volumes": volumes},
+                      checkpoint_file)
+        os.replace(self._filename + ".tmp", self._filename)
+
+    def track(self, liquids):
+        # Save the volumes `liquids` keeps with every step, a resumed run starts from the saved volumes
+        self._liquids = liquids
+        if self._volumes:
+            liquids.restore(self._volumes)
+
+    def finish(self):
+        if self.enabled and os.path.exists(self._filename):
+            os.remove(self._filename)
+
+
 def run(protocol_context):
 
     # This protocols is for  diluting primers that were received in 384well plate and 96-well from IDT.
     # The Opentrons must contain the plate defintion for correct type of 384-well and 96-well plate.
     # This protocol can add different volumes of water to different wells of the plate
 
+    [multi_dispense, disposal_volume, well_order, working_directory, water_volume, allow_duplicate_destinations,
+     timing_log, oligo_plates, labware_cache, checkpoint_file] = get_values(
+        "multi_dispense", "disposal_volume", "well_order", "working_directory", "water_volume", "allow_duplicate_destinations",
+        "timing_log", "oligo_plates", "labware_cache", "checkpoint"
+    )
+    [left_pipette, left_tiprack_slots, left_disposal_volume] = get_values(
+        "left_pipette", "left_tiprack_slots", "left_disposal_volume"
+    )
+
+    # The phase names match the phases of Simulation/runtime_estimator.py
+    log = StepLog(protocol_context, timing_log)
+
     # create labware
-    s_plate = protocol_context.load_labware("agilent_1_reservoir_290ml", '8', 'Source')
-    Oligos_plate_1 = protocol_context.load_labware("usascientific_96_wellplate_2.4ml_deep", '5', 'Oligos_1')
-    Oligos_plate_2 = protocol_context.load_labware("corning_384_wellplate_112ul_flat", '6', 'Oligos_2')
+    cache = read_labware_cache(labware_cache)
+    s_plate = load_labware(protocol_context, cache, "agilent_1_reservoir_290ml", '8', 'Source')
+    plates = dict((name, load_labware(protocol_context, cache, load_name, slot, name))
+                  for name, (picklist_name, load_name, slot) in oligo_plates.items())
 
     ################# Define Pipettes and Tip racks #############################
 
     slots2 = ["2", "3", "4"][:3]
-    tipracks2 = [ protocol_context.load_labware("opentrons_96_tiprack_300ul", slot)  for slot in slots2  ]
-    pipette_200 = protocol_context.load_instrument("p300_single_gen2", "right", tip_racks=tipracks2)
+    tipracks2 = [ load_labware(protocol_context, cache, "opentrons_96_tiprack_300ul", slot)  for slot in slots2  ]
+    pipette_200 = log.wrap(protocol_context.load_instrument("p300_single_gen2", "right", tip_racks=tipracks2))
+    pipettes = [pipette_200]
+    disposal_volumes = [disposal_volume]
+    if left_pipette:
+        tipracks_left = [load_labware(protocol_context, cache, "opentrons_96_tiprack_20ul", slot) for slot in left_tiprack_slots]
+        pipettes.append(log.wrap(protocol_context.load_instrument(left_pipette, "left", tip_racks=tipracks_left)))
+        disposal_volumes.append(left_disposal_volume)
    
     ###################
 
-    pipette_200.default_speed = 200
+    for pipette in pipettes:
+        pipette.default_speed = 200
     
-    # The picklist for adding water to DNA oligos, needs to be copied to Opentrons through SSH
-    # The picklist contains "Destination Well" and "Volume" as column
-    working_directory = "/data/user_storage"   # Copy the picklist here in Opentrons
-    filename = working_directory + '/Picklist_Oligos_1.csv'
-    picklist_oligos_1 = pd.read_csv(filename)
-
-    # when diluting primers, get water from reservoir
-    source = s_plate.wells_by_name()['A1'].bottom(6)
+    # The picklists for adding water to DNA oligos, need to be copied to Opentrons through SSH
+    # Each picklist contains "Destination Well" and "Volume" as column
+    # Every dose is a ((plate, well), volume, step) triple, so the plates form one stream of dispenses.
+    # The step names the picklist row in the checkpoint. Volumes below the minimum of the pipette
+    # that takes the smallest volumes are pipetted with a warning.
+    smallest = min(pipettes, key=lambda pipette: pipette.min_volume)
+    doses = []
+    dest_locations = dict()
+    for name, (picklist_name, load_name, slot) in oligo_plates.items():
+        picklist = load_picklist(protocol_context, working_directory + '/' + picklist_name, ["Destination Well", "Volume"],
+                                 plates[name], pipette=smallest, allow_duplicates=allow_duplicate_destinations)
+        doses.extend(((name, row.well), row.volume, name + ' row ' + str(i + 1)) for i, row in enumerate(picklist))
+        for well_name, location in well_locations(plates[name], "top", -6).items():
+            dest_locations[(name, well_name)] = location
+
+    # A restart with the same picklists and settings only adds the water that is still missing
+    key = hashlib.sha256(json.dumps([doses, multi_dispense, disposal_volumes, well_order, left_pipette]).encode()).hexdigest()
+    checkpoint = Checkpoint(protocol_context, checkpoint_file, key)
+    doses = [dose for dose in doses if dose[2] not in checkpoint]
+    for pipette in pipettes:
+        checkpoint.resume_tips(pipette)
+
+    # when diluting primers, get water from reservoir, 6 mm above the bottom once the level is low
+    source_well = s_plate.wells_by_name()['A1']
+    liquids = LiquidTracker(protocol_context)
+    liquids.add("water", source_well, "agilent_1_reservoir_290ml", water_volume, 6)
+    checkpoint.track(liquids)
+    liquids.plan("water", sum(volume for destination, volume, step in doses))
+    liquids.check()
+    log.phase("operator pause")
+    protocol_context.pause(liquids.fill_message())
     
-    # Adding water to 1st plate
-    pipette_200.pick_up_tip()
-    protocol_context.max_speeds['Z'] = 30 #Slow down the Z speed
-
-    for index, row in picklist_oligos_1.iterrows():
-        dest_well = picklist_oligos_1["Destination Well"].loc[index]
-        d_well =    Oligos_plate_1.wells_by_name()[dest_well].top(-6)
-        volume = float(picklist_oligos_1["Volume"].loc[index])
-        
-        pipette_200.transfer(volume, source, d_well, new_tip = 'never')
-        # Not chnaging tips during adding water from top of the well
-
-            
-    del protocol_context.max_speeds['Z']
-
-    pipette_200.drop_tip()
-    del picklist_guide
-
-    # Adding water to 2nd plate
-    filename2 = working_directory + '/Picklist_Oligos_2.csv'
-    picklist_oligos_2 = pd.read_csv(filename2)
-    pipette_200.pick_up_tip()
-    protocol_context.max_speeds['Z'] = 30
-
-    for index, row in picklist_oligos_2.iterrows():
-        dest_well = picklist_oligos_2["Destination Well"].loc[index]
-        d_well =    Oligos_plate_2.wells_by_name()[dest_well].top(-6)
-        volume = float(picklist_oligos_2["Volume"].loc[index])
-        
-        pipette_200.transfer(volume, source, d_well, new_tip = 'never')
-            
-    del protocol_context.max_speeds['Z']
-
-    pipette_200.drop_tip()
+    # Adding water to all plates with one tip per pipette, each pipette takes the doses that suit its volume
+    log.phase("water")
+    protocol_context.comment("Adding water to " + str(len(plates)) + " plates")
+    for pipette, pipette_doses in route_rows(doses, pipettes, lambda dose: dose[1]):
+        if len(pipettes) > 1:
+            protocol_context.comment(pipette.name + ': ' + str(len(pipette_doses)) + ' wells')
+        checkpoint.took_tip(pipette)
+        pipette.pick_up_tip()
+        protocol_context.max_speeds['Z'] = 30 #Slow down the Z speed
+
+        pipette_doses = order_picklist(protocol_context, pipette_doses, lambda dose: (xy(dest_locations[dose[0]]),) * 2,
+                                       xy(source_well.top()), well_order)
+        add_water(protocol_context, pipette, pipette_doses, dest_locations, liquids, multi_dispense,
+                  disposal_volumes[pipettes.index(pipette)], checkpoint)
+                
+        del protocol_context.max_speeds['Z']
 
+        pipette.drop_tip()
+    checkpoint.finish()
+    log.close()
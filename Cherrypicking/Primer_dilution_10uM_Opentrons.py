@@ -1,6 +1,10 @@
+import collections
 import csv 
+import hashlib
+import json
+import math
 import os
-import pandas as pd
+import time
 
 
 metadata = {
@@ -11,21 +15,477 @@ metadata = {
     }
 
 
+def get_values(*names):
+
+    dict1 = dict()
+
+    dict1["working_directory"] = "/data/user_storage"  # Copy the picklist here in Opentrons through SSH
+    dict1["well_order"] = "serpentine"  # picklist, serpentine or nearest
+    dict1["column_mode"] = True  # Move whole, aligned 8-well column blocks with an 8-channel pipette
+    # Pipette on the left mount: an 8-channel for column_mode, or a p20_single_gen2 that takes the volumes it
+    # suits from the p300 on the right mount. It is only loaded when the picklist gives it column blocks or rows,
+    # so a robot without it runs picklists that have none. None leaves the left mount empty.
+    dict1["left_pipette"] = "p300_multi_gen2"
+    dict1["multi_tiprack_slots"] = ["1", "7", "9", "10", "11"]  # Tip racks for the left pipette
+    dict1["primer_transfer_seconds"] = 20  # Approximate time of one primer transfer including the tip change
+    dict1["allow_duplicate_destinations"] = False  # True accepts several picklist rows for the same well
+    dict1["timing_log"] = "/data/user_storage/timing_log.jsonl"  # JSON lines timing of real runs, None turns it off
+    # Labware definitions built by Simulation/labware_cache.py, None loads the labware from the robot's own library
+    dict1["labware_cache"] = None
+    # Progress of a real run, a restarted run with the same picklist skips the rows already done. None turns it off.
+    dict1["checkpoint"] = "/data/user_storage/primer_dilution_checkpoint.json"
+    # Source plates by the name used in the picklist's "Source Plate" column: (labware, deck slot).
+    # Picklists without that column take every primer from the first plate.
+    dict1["source_plates"] = {"Primers": ("corning_384_wellplate_112ul_flat", "5")}
+
+    _all_values = dict1
+
+    return [_all_values[n] for n in names]
+
+
+def read_labware_cache(filename):
+
+    # Labware definitions by load name from the cache Simulation/labware_cache.py builds, the latest version of
+    # each. Without the file every labware comes from the robot's labware library as usual.
+    if not filename or not os.path.exists(filename):
+        return dict()
+    with open(filename) as cache_file:
+        entries = sorted(json.load(cache_file)["labware"].values(), key=lambda entry: entry["version"])
+    return dict((entry["definition"]["parameters"]["loadName"], entry["definition"]) for entry in entries)
+
+
+def load_labware(parent, cache, load_name, location=None, label=None):
+
+    # Load labware on the deck, or on a module when `parent` is a module and there is no location,
+    # from its cached definition when the cache has one
+    definition = cache.get(load_name)
+    if location is None:
+        if definition:
+            return parent.load_labware_from_definition(definition, label)
+        return parent.load_labware(load_name, label)
+    if definition:
+        return parent.load_labware_from_definition(definition, location, label)
+    return parent.load_labware(load_name, location, label)
+
+
+PicklistRow = collections.namedtuple("PicklistRow", ["well", "volume", "source_well", "source_plate"])
+
+
+def read_picklist(filename, columns, default_source_plate=None):
+
+    # Stream the picklist CSV as PicklistRow records using the csv module only, so pandas
+    # does not have to be imported on the robot. `columns` are the headers the picklist must have.
+    # "Volume" and "Source Well" are optional and come back as None when the picklist has no such column,
+    # rows without a "Source Plate" come from `default_source_plate`.
+
+    with open(filename, newline='', encoding='utf-8-sig') as picklist_file:
+        reader = csv.DictReader(picklist_file)
+        missing = [column for column in columns if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(filename + ' is missing the column(s): ' + ', '.join(missing))
+
+        for line in reader:
+            volume = line.get("Volume")
+            source_well = line.get("Source Well")
+            source_plate = line.get("Source Plate")
+            yield PicklistRow(line["Destination Well"].strip(),
+                              float(volume) if volume else None,
+                              source_well.strip() if source_well else None,
+                              source_plate.strip() if source_plate else default_source_plate)
+
+
+def validate_picklist(filename, picklist, dest_labware, source_plates=None, pipette=None, allow_duplicates=False):
+
+    # Check the rows against the labware they are pipetted into and from before anything moves:
+    # every well exists, every volume fits into its well and no well is a destination twice.
+    # Returns the rows below the minimum volume of the pipette.
+    problems = []
+    small = []
+    dest_wells = dest_labware.wells_by_name()
+    seen = set()
+
+    for line, row in enumerate(picklist, 2):
+        if row.well not in dest_wells:
+            problems.append('line ' + str(line) + ': no well ' + row.well + ' on ' + dest_labware.load_name)
+        elif row.volume is not None and row.volume > dest_wells[row.well].max_volume:
+            problems.append('line ' + str(line) + ': ' + str(row.volume) + ' ul do not fit into ' + row.well)
+        if source_plates is not None:
+            if row.source_plate not in source_plates:
+                problems.append('line ' + str(line) + ': unknown source plate ' + str(row.source_plate))
+            elif row.source_well not in source_plates[row.source_plate].wells_by_name():
+                problems.append('line ' + str(line) + ': no source well ' + str(row.source_well) + ' on ' + row.source_plate)
+        if pipette is not None and row.volume is not None and row.volume < pipette.min_volume:
+            small.append('line ' + str(line) + ': ' + str(row.volume) + ' ul')
+        if row.well in seen and not allow_duplicates:
+            problems.append('line ' + str(line) + ': ' + row.well + ' is a destination more than once')
+        seen.add(row.well)
+
+    if problems:
+        raise ValueError(filename + ' has ' + str(len(problems)) + ' problem(s): ' + '; '.join(problems[:10]))
+    return small
+
+
+def load_picklist(protocol_context, filename, columns, dest_labware, source_plates=None, pipette=None,
+                  allow_duplicates=False):
+
+    # Read and validate a picklist. Volumes below the minimum of the pipette are still transferred,
+    # the run only warns about them
+    picklist = list(read_picklist(filename, columns, next(iter(source_plates)) if source_plates else None))
+    small = validate_picklist(filename, picklist, dest_labware, source_plates, pipette, allow_duplicates)
+    if small:
+        message = ('Warning: ' + str(len(small)) + ' row(s) of ' + os.path.basename(filename) + ' are below the ' +
+                   str(pipette.min_volume) + ' ul minimum of ' + pipette.name + ': ' + '; '.join(small[:10]))
+        if pipette.name != 'p20_single_gen2':
+            message += '. Set left_pipette = "p20_single_gen2" to pipette them accurately'
+        protocol_context.comment(message)
+    return picklist
+
+
+def well_locations(labware, position, offset):
+
+    # Map every well name of the labware to one location in that well, e.g. top(-6).
+    # Built once per labware so the loops don't rebuild wells_by_name() for every picklist row.
+    return dict((name, getattr(well, position)(offset)) for name, well in labware.wells_by_name().items())
+
+
+def xy(location):
+    return (location.point.x, location.point.y)
+
+
+def travel_distance(points, start):
+
+    # Estimated XY travel in mm when the gantry starts at `start` and visits each
+    # (first, last) point pair of `points` in order
+    distance = 0
+    position = start
+    for first, last in points:
+        distance = distance + math.hypot(first[0] - position[0], first[1] - position[1])
+        distance = distance + math.hypot(last[0] - first[0], last[1] - first[1])
+        position = last
+    return distance
+
+
+def order_picklist(protocol_context, picklist, locate, start, mode):
+
+    # Reorder picklist rows to shorten gantry travel before they are pipetted.
+    # locate(row) returns the XY of the first and last well a row visits.
+    # mode: "picklist" keeps the CSV order, "serpentine" walks the plate column by column
+    # alternating down and up, "nearest" always moves to the closest remaining well.
+    # The picklist order is kept unless the reordered rows travel less.
+
+    points = [locate(row) for row in picklist]
+    order = list(range(len(picklist)))
+
+    if mode == "serpentine":
+        columns = sorted(set(round(first[0], 1) for first, last in points))
+        column_index = dict((x, i) for i, x in enumerate(columns))
+
+        def serpentine_key(i):
+            x, y = points[i][0]
+            column = column_index[round(x, 1)]
+            return (column, y if column % 2 else -y)
+
+        order.sort(key=serpentine_key)
+
+    elif mode == "nearest":
+        remaining = order
+        order = []
+        position = start
+        while remaining:
+            i = min(remaining, key=lambda j: math.hypot(points[j][0][0] - position[0], points[j][0][1] - position[1]))
+            remaining.remove(i)
+            order.append(i)
+            position = points[i][1]
+
+    elif mode != "picklist":
+        raise ValueError('Unknown well order "' + str(mode) + '", use picklist, serpentine or nearest')
+
+    before = travel_distance(points, start)
+    after = travel_distance([points[i] for i in order], start)
+    kept = mode != "picklist" and after >= before
+    protocol_context.comment('Estimated XY travel: ' + str(round(before)) + ' mm in picklist order, ' +
+                             str(round(after)) + ' mm in ' + mode + ' order' +
+                             (', the picklist order is kept' if kept else ''))
+    if kept:
+        return list(picklist)
+
+    return [picklist[i] for i in order]
+
+
+# Tip racks of the pipettes that can be mounted on the left
+TIPRACKS = {
+    "p300_multi_gen2": "opentrons_96_tiprack_300ul",
+    "p20_multi_gen2": "opentrons_96_tiprack_20ul",
+    "p20_single_gen2": "opentrons_96_tiprack_20ul",
+}
+
+
+# Channels and volume range in ul of the pipettes that can be mounted on the left, used before it is loaded
+LEFT_PIPETTE_SIZES = {
+    "p300_multi_gen2": (8, 20, 300),
+    "p20_multi_gen2": (8, 1, 20),
+    "p20_single_gen2": (1, 1, 20),
+}
+
+
+class PipetteSize:
+
+    # Volume range of a pipette that is not loaded yet, stands in for it in route_rows()
+
+    def __init__(self, min_volume, max_volume):
+        self.min_volume = min_volume
+        self.max_volume = max_volume
+
+
+def route_rows(rows, pipettes, volume):
+
+    # Send every row to the smallest pipette that takes its volume, `volume(row)`, in one aspiration.
+    # Rows no pipette takes in one go go to the largest one, which splits them. Returns (pipette, rows)
+    # batches in the order of `pipettes`, so each pipette handles all its rows before the next one starts.
+    by_size = sorted(pipettes, key=lambda pipette: pipette.max_volume)
+    batches = [(pipette, []) for pipette in pipettes]
+    for row in rows:
+        fitting = [pipette for pipette in by_size if pipette.min_volume <= volume(row) <= pipette.max_volume]
+        pipette = fitting[0] if fitting else by_size[-1]
+        batches[pipettes.index(pipette)][1].append(row)
+    return [(pipette, pipette_rows) for pipette, pipette_rows in batches if pipette_rows]
+
+
+def split_well_name(name):
+    # "B12" -> (1, 12): zero based row index and column number
+    letters = name.rstrip("0123456789")
+    row = 0
+    for letter in letters:
+        row = row * 26 + ord(letter) - ord("A") + 1
+    return row - 1, int(name[len(letters):])
+
+
+def join_well_name(row, column):
+    letters = ""
+    row = row + 1
+    while row:
+        row, remainder = divmod(row - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters + str(column)
+
+
+def split_column_blocks(picklist, source_rows, dest_rows, channels=8):
+
+    # Find picklist rows that an 8-channel pipette can move in one go: 8 source wells of one
+    # column that start at the first nozzle position (A, or A/B on a 384 plate where the nozzles
+    # reach every other row) going to an equally aligned destination column in the same order.
+    # Returns the blocks (lists of 8 rows, first row under the A1 nozzle) and the leftover rows.
+
+    source_step = source_rows // channels
+    dest_step = dest_rows // channels
+
+    by_source = dict()
+    for i, row in enumerate(picklist):
+        by_source.setdefault(row.source_well, []).append(i)
+
+    used = set()
+    blocks = []
+    for i, row in enumerate(picklist):
+        if i in used:
+            continue
+        source_row, source_column = split_well_name(row.source_well)
+        if source_row >= source_step:
+            continue
+
+        members = []
+        for k in range(channels):
+            name = join_well_name(source_row + k * source_step, source_column)
+            candidates = [j for j in by_source.get(name, []) if j not in used and j not in members]
+            if not candidates:
+                break
+            members.append(candidates[0])
+        if len(members) < channels:
+            continue
+
+        dests = [split_well_name(picklist[j].well) for j in members]
+        dest_row, dest_column = dests[0]
+        if dest_row < dest_step and all(dests[k] == (dest_row + k * dest_step, dest_column) for k in range(channels)):
+            blocks.append([picklist[j] for j in members])
+            used.update(members)
+
+    leftovers = [row for i, row in enumerate(picklist) if i not in used]
+    return blocks, leftovers
+
+
+# Positions of the volume and location arguments of the pipette calls the step log records
+LOGGED_CALLS = {
+    "aspirate": (0, 1), "dispense": (0, 1), "mix": (1, 2), "transfer": (0, 2), "air_gap": (0, None),
+    "blow_out": (None, 0), "touch_tip": (None, 0), "pick_up_tip": (None, 0), "return_tip": (None, None),
+    "drop_tip": (None, 0),
+}
+
+
+def describe_location(location):
+    # "A1 of reagent reservoir on 7" for a well or a location in a well
+    target = getattr(location, "labware", location)
+    return str(getattr(target, "object", target))
+
+
+class StepLog:
+
+    # Timing log of a real run: every phase and every liquid handling call of a wrapped pipette becomes one
+    # JSON line with its phase, well, action, volume and start and end time. Each line is appended to the
+    # log file as soon as it is logged, so a run that is stopped keeps its log up to the last call.
+    # Nothing is logged while the protocol is simulated or analyzed.
+
+    def __init__(self, protocol_context, filename):
+        self.enabled = filename is not None and not protocol_context.is_simulating()
+        self._filename = filename
+        self._run = time.strftime("%Y%m%d-%H%M%S")
+        self._phase = "setup"
+        self._phase_start = time.time()
+
+    def phase(self, name):
+        # End the current phase and start phase `name`
+        if not self.enabled:
+            return
+        now = time.time()
+        self._add({"event": "phase", "phase": self._phase, "start": self._phase_start, "end": now})
+        self._phase = name
+        self._phase_start = now
+
+    def step(self, action, start, end, location=None, volume=None):
+        self._add({"event": "step", "phase": self._phase, "action": action, "start": start, "end": end,
+                   "well": describe_location(location) if location is not None else None, "volume": volume})
+
+    def wrap(self, pipette):
+        # The pipette itself when nothing is logged, otherwise a stand-in that logs its liquid handling calls
+        return LoggedPipette(pipette, self) if self.enabled else pipette
+
+    def _add(self, event):
+        event["run"] = self._run
+        with open(self._filename, "a") as log_file:
+            log_file.write(json.dumps(event) + "\n")
+
+    def close(self):
+        self.phase("end")
+
+
+class LoggedPipette:
+
+    # Forwards everything to the pipette and reports the calls in LOGGED_CALLS to the step log
+
+    def __init__(self, pipette, log):
+        object.__setattr__(self, "_pipette", pipette)
+        object.__setattr__(self, "_log", log)
+
+    def __setattr__(self, name, value):
+        setattr(self._pipette, name, value)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._pipette, name)
+        if name not in LOGGED_CALLS:
+            return attribute
+
+        volume_index, location_index = LOGGED_CALLS[name]
+
+        def logged(*args, **kwargs):
+            start = time.time()
+            result = attribute(*args, **kwargs)
+            volume = args[volume_index] if volume_index is not None and len(args) > volume_index else kwargs.get("volume")
+            location = args[location_index] if location_index is not None and len(args) > location_index else kwargs.get("location")
+            self._log.step(name, start, time.time(), location, volume)
+            return result
+
+        return logged
+
+
+class Checkpoint:
+
+    # Progress of a real run in a JSON file: the steps that are done (picklist rows, columns or phases) and the
+    # number of tips taken from the racks of each mount. The file is rewritten after every completed step.
+    # A run with the same settings that starts while the file is there skips the steps that are done and
+    # starts every pipette at its first unused tip; the file is removed when the run finishes.
+    # Nothing is read or written while the protocol is simulated or analyzed.
+
+    def __init__(self, protocol_context, filename, key):
+        self.enabled = filename is not None and not protocol_context.is_simulating()
+        self._filename = filename
+        self._key = key
+        self._done = set()
+        self._tips = dict()
+        if self.enabled and os.path.exists(filename):
+            with open(filename) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if state["key"] == key:
+                self._done = set(state["done"])
+                self._tips = state["tips"]
+                protocol_context.comment('Resuming from ' + filename + ': ' + str(len(self._done)) + ' steps are done')
+
+    def __contains__(self, step):
+        return step in self._done
+
+    def complete(self, step):
+        self._done.add(step)
+        self._save()
+
+    def took_tip(self, pipette, count=1):
+        # Record the tips `pipette` is about to pick up, so a restart never goes back to a taken tip
+        self._tips[pipette.mount] = self._tips.get(pipette.mount, 0) + count
+        self._save()
+
+    def tips_taken(self, pipette):
+        return self._tips.get(pipette.mount, 0)
+
+    def resume_tips(self, pipette):
+        # Start `pipette` at the first tip of its racks the earlier runs did not take
+        used = self.tips_taken(pipette)
+        if used:
+            if pipette.channels == 8:
+                tips = [column[0] for rack in pipette.tip_racks for column in rack.columns()]
+            else:
+                tips = [well for rack in pipette.tip_racks for well in rack.wells()]
+            if used >= len(tips):
+                raise ValueError('All tips of the ' + pipette.name + ' were used, refill its tip racks and remove ' + self._filename)
+            pipette.starting_tip = tips[used]
+
+    def _save(self):
+        if not self.enabled:
+            return
+        # Written next to the checkpoint and renamed, so an abort never leaves half a file behind
+        with open(self._filename + ".tmp", "w") as checkpoint_file:
+            json.dump({"key": self._key, "done": sorted(self._done), "tips": self._tips}, checkpoint_file)
+        os.replace(self._filename + ".tmp", self._filename)
+
+    def finish(self):
+        if self.enabled and os.path.exists(self._filename):
+            os.remove(self._filename)
+
+
 def run(protocol_context):
 
-    # Transfer the stock primers from IDT 384-well plate to Corning 384-well plate and dilute to 10uM.
-    # The corning 384-well plate will be used in ECHO liquid handler as source plate.
+    # Transfer the stock primers from one or more IDT 96-well or 384-well plates to Corning 384-well plate
+    # and dilute to 10uM. The corning 384-well plate will be used in ECHO liquid handler as source plate.
+
+    [working_directory, well_order, column_mode, multi_tiprack_slots, primer_transfer_seconds,
+     allow_duplicate_destinations, source_plates] = get_values(
+        "working_directory", "well_order", "column_mode", "multi_tiprack_slots", "primer_transfer_seconds",
+        "allow_duplicate_destinations", "source_plates"
+    )
+    [timing_log, labware_cache, left_pipette, checkpoint_file] = get_values(
+        "timing_log", "labware_cache", "left_pipette", "checkpoint"
+    )
+
+    # The phase names match the phases of Simulation/runtime_estimator.py
+    log = StepLog(protocol_context, timing_log)
     
-    # primer_plate = protocol_context.load_labware("nest_96_wellplate_2ml_deep", '5', 'Primer')
+    # e.g. source_plates = {"IDT_1": ("nest_96_wellplate_2ml_deep", "5"), "IDT_2": ("corning_384_wellplate_112ul_flat", "7")}
 
-    water_plate = protocol_context.load_labware("agilent_1_reservoir_290ml", '8', 'Water')
-    primer_plate = protocol_context.load_labware("corning_384_wellplate_112ul_flat", '5', 'Primers')
-    d_plate = protocol_context.load_labware("corning_384_wellplate_112ul_flat", '6', 'Destination')
+    cache = read_labware_cache(labware_cache)
+    water_plate = load_labware(protocol_context, cache, "agilent_1_reservoir_290ml", '8', 'Water')
+    primer_plates = dict((name, load_labware(protocol_context, cache, load_name, slot, name))
+                         for name, (load_name, slot) in source_plates.items())
+    d_plate = load_labware(protocol_context, cache, "corning_384_wellplate_112ul_flat", '6', 'Destination')
 
     ################# Define Pipettes and Tip racks #############################
     slots2 = ["2", "3", "4"][:3]
-    tipracks2 = [ protocol_context.load_labware("opentrons_96_tiprack_300ul", slot)  for slot in slots2  ]
-    pipette_200 = protocol_context.load_instrument("p300_single_gen2", "right", tip_racks=tipracks2)
+    tipracks2 = [ load_labware(protocol_context, cache, "opentrons_96_tiprack_300ul", slot)  for slot in slots2  ]
+    pipette_200 = log.wrap(protocol_context.load_instrument("p300_single_gen2", "right", tip_racks=tipracks2))
     ###################
 
     pipette_200.default_speed = 200
@@ -33,37 +493,159 @@ def run(protocol_context):
 
     # The picklist for adding water to DNA oligos, needs to be copied to Opentrons through SSH
     # The picklist contains "Source Well" "Destination Well" and "Volume" as column
-    working_directory = "/data/user_storage"
     filename = working_directory + '/Picklist_primer_dilution.csv'
-    picklist_df = pd.read_csv(filename)
+    picklist = load_picklist(protocol_context, filename, ["Source Well", "Destination Well"], d_plate,
+                             source_plates=primer_plates, allow_duplicates=allow_duplicate_destinations)
+
+    # A restart with the same picklist and settings skips the rows that are done. The checkpoint steps name
+    # the rows by their line in the picklist, e.g. "water row 12" and "primer row 12".
+    key = hashlib.sha256(json.dumps([picklist, column_mode, left_pipette, well_order, source_plates]).encode()).hexdigest()
+    checkpoint = Checkpoint(protocol_context, checkpoint_file, key)
+    row_numbers = dict((id(row), str(i + 1)) for i, row in enumerate(picklist))
+
+    def step(phase, row):
+        return phase + ' row ' + row_numbers[id(row)]
 
     water_source = water_plate.wells_by_name()['A1'].bottom(5)
+    d_plate_bottoms_4 = well_locations(d_plate, "bottom", 4)
+    d_plate_bottoms_2 = well_locations(d_plate, "bottom", 2)
+    source_bottoms = dict((name, well_locations(plate, "bottom", 2)) for name, plate in primer_plates.items())
     water_volume = 54
     primer_volume = 6
     # The maximum volume of liquid in each well is 65ul for ECHO source plate
 
-    pipette_200.pick_up_tip()
-    protocol_context.max_speeds['Z'] = 30 
+    # The left pipette is only loaded once it is known to get column blocks or rows, until then its size
+    # comes from LEFT_PIPETTE_SIZES
+    left_channels, left_min_volume, left_max_volume = LEFT_PIPETTE_SIZES[left_pipette] if left_pipette else (0, 0, 0)
+    left_size = PipetteSize(left_min_volume, left_max_volume)
+
+    # Whole column blocks go to an 8-channel pipette on the left, the rest stays on the single-channel.
+    # Transfers are grouped by source plate in the order of source_plates.
+    blocks = []
+    if column_mode and left_channels == 8:
+        leftovers = []
+        for name, plate in primer_plates.items():
+            plate_blocks, plate_rows = split_column_blocks([row for row in picklist if row.source_plate == name],
+                                                           len(plate.rows()), len(d_plate.rows()))
+            blocks = blocks + plate_blocks
+            leftovers = leftovers + plate_rows
+        picklist = leftovers
+    water_blocks = [block for block in blocks if step('water', block[0]) not in checkpoint]
+    primer_blocks = [block for block in blocks if step('primer', block[0]) not in checkpoint]
+
+    # The single-channel rows go to the p300 or a p20 on the left by volume
+    single_pipettes = [pipette_200]
+    if left_channels == 1:
+        single_pipettes.append(left_size)
+    water_batches = route_rows([row for row in picklist if step('water', row) not in checkpoint],
+                               single_pipettes, lambda row: water_volume)
+    primer_batches = route_rows([row for row in picklist if step('primer', row) not in checkpoint],
+                                single_pipettes, lambda row: primer_volume)
+
+    # The left pipette has no tip racks yet, they are loaded once it is known how many tips it needs
+    pipette_left = None
+    if water_blocks or primer_blocks or any(pipette is left_size for pipette, rows in water_batches + primer_batches):
+        pipette_left = log.wrap(protocol_context.load_instrument(left_pipette, "left"))
+        pipette_left.default_speed = 200
+        water_batches = [(pipette_left if pipette is left_size else pipette, rows) for pipette, rows in water_batches]
+        primer_batches = [(pipette_left if pipette is left_size else pipette, rows) for pipette, rows in primer_batches]
+
+    if pipette_left:
+        # One tip for the water and one per primer transfer, the 8-channel takes a whole column of tips each time.
+        # The racks also hold the tips an earlier, aborted run took.
+        if pipette_left.channels == 8:
+            tips_needed = len(primer_blocks) + (1 if water_blocks else 0)
+        else:
+            tips_needed = (len([pipette for pipette, rows in water_batches if pipette is pipette_left]) +
+                           sum(len(rows) for pipette, rows in primer_batches if pipette is pipette_left))
+        tips_needed = tips_needed + checkpoint.tips_taken(pipette_left)
+        tiprack_number = math.ceil(tips_needed / (96 // pipette_left.channels))
 
-    # Adding water first to all wells 
-    for index, row in picklist_df.iterrows():
-        Water_dest = picklist_df["Destination Well"].loc[index]
-        Water_dest_Well = d_plate.wells_by_name()[Water_dest].bottom(4)
-        pipette_200.transfer(water_volume, water_source, Water_dest_Well, new_tip='never')
+        source_slots = [slot for load_name, slot in source_plates.values()]
+        free_slots = [slot for slot in multi_tiprack_slots if slot not in source_slots]
+        if tiprack_number > len(free_slots):
+            raise ValueError(left_pipette + ' needs ' + str(tiprack_number) + ' tip racks but only ' +
+                             str(len(free_slots)) + ' multi_tiprack_slots are free of source plates')
+        pipette_left.tip_racks = [load_labware(protocol_context, cache, TIPRACKS[left_pipette], slot)
+                                  for slot in free_slots[:tiprack_number]]
+        checkpoint.resume_tips(pipette_left)
+    checkpoint.resume_tips(pipette_200)
 
-    pipette_200.drop_tip()
+    log.phase("water")
+    protocol_context.comment("Adding water")
+    if blocks:
+        single_transfers = len(picklist) + 8 * len(blocks)
+        multi_transfers = len(picklist) + len(blocks)
+        protocol_context.comment('Column mode: ' + str(len(blocks)) + ' column blocks on the 8-channel, ' +
+                                 str(len(picklist)) + ' rows on the single-channel')
+        protocol_context.comment('Primer tip pick-ups and transfers: ' + str(multi_transfers) + ' instead of ' +
+                                 str(single_transfers) + ', about ' +
+                                 str(round((single_transfers - multi_transfers) * primer_transfer_seconds / 60)) + ' minutes saved')
+
+    if water_blocks:
+        # Adding water to the column blocks
+        checkpoint.took_tip(pipette_left)
+        pipette_left.pick_up_tip()
+        protocol_context.max_speeds['Z'] = 30
+        for block in water_blocks:
+            pipette_left.transfer(water_volume, water_source, d_plate_bottoms_4[block[0].well], new_tip='never')
+            checkpoint.complete(step('water', block[0]))
+        pipette_left.drop_tip()
+
+    # Adding water first to all wells, one tip per pipette
+    for pipette, rows in water_batches:
+        checkpoint.took_tip(pipette)
+        pipette.pick_up_tip()
+        protocol_context.max_speeds['Z'] = 30 
+
+        water_picklist = order_picklist(protocol_context, rows, lambda row: (xy(d_plate_bottoms_4[row.well]),) * 2,
+                                        xy(water_source), well_order)
+        for row in water_picklist:
+            Water_dest_Well = d_plate_bottoms_4[row.well]
+            pipette.transfer(water_volume, water_source, Water_dest_Well, new_tip='never')
+            checkpoint.complete(step('water', row))
+
+        pipette.drop_tip()
     
-    protocol_context.pause("Centrifuge the corning 384 well plate")
+    if 'centrifuge' not in checkpoint:
+        log.phase("operator pause")
+        protocol_context.pause("Centrifuge the corning 384 well plate")
+        checkpoint.complete('centrifuge')
+
+    log.phase("primer transfer")
+    protocol_context.comment("Transferring primers")
+
+    # Transfer the primer column blocks with the 8-channel pipette. The tip is recorded before the transfer
+    # picks it up, a restart never goes back to a tip that was taken.
+    for block in primer_blocks:
+        checkpoint.took_tip(pipette_left)
+        pipette_left.transfer(primer_volume, source_bottoms[block[0].source_plate][block[0].source_well],
+        d_plate_bottoms_2[block[0].well], air_gap=10, new_tip='always', blow_out=True, blowout_location='destination well')
+        checkpoint.complete(step('primer', block[0]))
+
+    # Transfer primers  to corning 384 well plate, one pipette and within it one source plate after the other.
+    # The p300 needs an air gap to deliver the few ul of primer, a p20 takes them accurately without one.
+    for pipette, pipette_rows in primer_batches:
+        air_gap = 10 if pipette.max_volume > 20 else 0
 
-    # Transfer primers  to corning 384 well plate
-    for index, row in picklist_df.iterrows():
-        Primer_dest = picklist_df["Destination Well"].loc[index]
-        Primer_dest_well = d_plate.wells_by_name()[Primer_dest].bottom(2)
+        for name in primer_plates:
+            rows = [row for row in pipette_rows if row.source_plate == name]
+            if not rows:
+                continue
 
-        Primer_source = picklist_df["Source Well"].loc[index]
-        Primer_source_well = d_plate.wells_by_name()[Primer_source].bottom(2)
+            protocol_context.comment('Source plate ' + name + ': ' + str(len(rows)) + ' primers')
+            primer_picklist = order_picklist(protocol_context, rows,
+                                             lambda row: (xy(source_bottoms[name][row.source_well]), xy(d_plate_bottoms_2[row.well])),
+                                             xy(source_bottoms[name]['A1']), well_order)
+            for row in primer_picklist:
+                Primer_dest_well = d_plate_bottoms_2[row.well]
 
-        pipette_200.transfer(primer_volume, Primer_source_well, Primer_dest_well, air_gap=10, new_tip='always', 
-        blow_out=True, blowout_location='destination well')
+                Primer_source_well = source_bottoms[name][row.source_well]
 
+                checkpoint.took_tip(pipette)
+                pipette.transfer(primer_volume, Primer_source_well, Primer_dest_well, air_gap=air_gap, new_tip='always', 
+                blow_out=True, blowout_location='destination well')
+                checkpoint.complete(step('primer', row))
 
+    checkpoint.finish()
+    log.close()
@@ -0,0 +1,149 @@
+import argparse
+import collections
+import csv
+import os
+import sys
+import time
+
+import numpy as np
+
+
+# Offline calculator of the water volumes that bring dried oligos to a target concentration.
+# It reads the vendor's yield sheet (one row per well with its yield in nmol) and writes the picklist
+# Dilute_Oligos_Opentrons_Cherrypicking.py reads, with "Destination Well" and "Volume" columns.
+# All volumes are computed at once with numpy and capped at the well volume of the plate; the capped wells
+# end up above the target concentration and are listed.
+# numpy is only needed on the computer the picklists are made on, not on the robot.
+#
+# Usage:
+#   python Cherrypicking/resuspension_volumes.py yields.csv --concentration 100 --output Picklist_Oligos_1.csv
+#   python Cherrypicking/resuspension_volumes.py yields.csv --labware corning_384_wellplate_112ul_flat --output Picklist_Oligos_2.csv
+#   python Cherrypicking/resuspension_volumes.py order.csv --plate-column "Plate Name" --output "Picklist_{plate}.csv"
+
+
+# Plates the oligos are delivered in: rows, columns and the volume of one well in ul
+PLATES = {
+    "usascientific_96_wellplate_2.4ml_deep": (8, 12, 2400),
+    "nest_96_wellplate_2ml_deep": (8, 12, 2000),
+    "corning_384_wellplate_112ul_flat": (16, 24, 112),
+}
+
+MIN_VOLUME = 20  # ul, smallest volume of the p300 single channel that dispenses the water
+LISTED_WELLS = 20  # Capped or too small wells printed by name, the rest are only counted
+
+YieldSheet = collections.namedtuple("YieldSheet", ["wells", "nmol", "plates"])
+
+
+def read_yield_sheet(filename, well_column, yield_column, plate_column=None):
+
+    # Wells, yields in nmol as an array and the plate of every row, or None without a plate column
+    with open(filename, newline='', encoding='utf-8-sig') as sheet_file:
+        reader = csv.DictReader(sheet_file)
+        columns = [column for column in [well_column, yield_column, plate_column] if column]
+        missing = [column for column in columns if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(filename + ' is missing the column(s): ' + ', '.join(missing))
+        rows = [line for line in reader if line[well_column].strip()]
+
+    wells = [line[well_column].strip() for line in rows]
+    try:
+        nmol = np.array([float(line[yield_column]) for line in rows])
+    except ValueError as error:
+        raise ValueError(filename + ': the ' + yield_column + ' column must be numbers, ' + str(error))
+    plates = [line[plate_column].strip() for line in rows] if plate_column else None
+    return YieldSheet(wells, nmol, plates)
+
+
+def well_names(load_name):
+    rows, columns, max_volume = PLATES[load_name]
+    return set(chr(ord("A") + row) + str(column) for row in range(rows) for column in range(1, columns + 1))
+
+
+def check_wells(filename, wells, nmol, load_name):
+
+    # Every well exists on the plate, is listed once and has a positive yield
+    problems = []
+    names = well_names(load_name)
+    seen = set()
+    for line, (well, amount) in enumerate(zip(wells, nmol), 2):
+        if well not in names:
+            problems.append('line ' + str(line) + ': no well ' + well + ' on ' + load_name)
+        if well in seen:
+            problems.append('line ' + str(line) + ': ' + well + ' is listed more than once')
+        if not amount > 0:
+            problems.append('line ' + str(line) + ': ' + str(amount) + ' nmol in ' + well)
+        seen.add(well)
+    if problems:
+        raise ValueError(filename + ' has ' + str(len(problems)) + ' problem(s): ' + '; '.join(problems[:10]))
+
+
+def resuspension_volumes(nmol, concentration, max_volume):
+
+    # Water in ul that brings `nmol` to `concentration` uM: nmol / uM gives litres * 1e-3, i.e. * 1000 ul.
+    # Returns the volumes rounded to 0.1 ul and capped at max_volume, and a mask of the capped wells.
+    volumes = nmol * 1000.0 / concentration
+    capped = volumes > max_volume
+    return np.round(np.minimum(volumes, max_volume), 1), capped
+
+
+def write_picklist(filename, wells, volumes):
+    with open(filename, "w", newline="") as picklist_file:
+        writer = csv.writer(picklist_file)
+        writer.writerow(["Destination Well", "Volume"])
+        writer.writerows(zip(wells, volumes.tolist()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Water volumes for a target oligo concentration from a yield sheet")
+    parser.add_argument("sheet", help="yield sheet CSV with one row per well")
+    parser.add_argument("--concentration", type=float, default=100, help="target concentration in uM (default 100)")
+    parser.add_argument("--labware", default="usascientific_96_wellplate_2.4ml_deep", choices=sorted(PLATES),
+                        help="plate the oligos are in, its well volume caps the water volume")
+    parser.add_argument("--well-column", default="Well Position", help="column of the sheet with the well")
+    parser.add_argument("--yield-column", default="nmoles", help="column of the sheet with the yield in nmol")
+    parser.add_argument("--max-volume", type=float, help="cap in ul, defaults to the well volume of --labware")
+    parser.add_argument("--plate-column", help="column naming the plate of each row, writes one picklist per plate")
+    parser.add_argument("--output", default="Picklist_Oligos_1.csv",
+                        help="picklist to write, with --plate-column a name containing {plate}")
+    args = parser.parse_args(argv)
+
+    if args.plate_column and "{plate}" not in args.output:
+        parser.error("--output needs {plate} in its name when --plate-column is given")
+
+    start = time.perf_counter()
+    sheet = read_yield_sheet(args.sheet, args.well_column, args.yield_column, args.plate_column)
+    max_volume = args.max_volume or PLATES[args.labware][2]
+    volumes, capped = resuspension_volumes(sheet.nmol, args.concentration, max_volume)
+
+    # One picklist per plate, the rows of a plate keep the order of the sheet
+    plates = np.array(sheet.plates if sheet.plates else [""] * len(sheet.wells))
+    wells = np.array(sheet.wells)
+    written = []
+    for plate in dict.fromkeys(plates.tolist()):
+        rows = plates == plate
+        check_wells(args.sheet + (' plate ' + plate if plate else ''), wells[rows].tolist(), sheet.nmol[rows], args.labware)
+        filename = args.output.format(plate=plate)
+        write_picklist(filename, wells[rows].tolist(), volumes[rows])
+        written.append(filename)
+    seconds = time.perf_counter() - start
+
+    print(str(len(wells)) + " wells in " + str(len(written)) + " picklist(s) in " + "{:.1f}".format(seconds * 1000) + " ms: " +
+          ", ".join(os.path.basename(filename) for filename in written))
+    print("Water: " + "{:.1f}".format(volumes.sum() / 1000) + " ml in total, " + "{:.1f}".format(volumes.min()) + " to " +
+          "{:.1f}".format(volumes.max()) + " ul per well")
+
+    names = np.char.add(np.char.add(plates, np.where(plates == "", "", " ")), wells)
+    capped_wells = np.flatnonzero(capped)
+    print(str(len(capped_wells)) + " well(s) capped at " + "{:g}".format(max_volume) + " ul, above " +
+          "{:g}".format(args.concentration) + " uM")
+    for i in capped_wells[:LISTED_WELLS]:
+        print("  " + names[i] + ": " + "{:.1f}".format(sheet.nmol[i] * 1000 / max_volume) + " uM")
+    small_wells = np.flatnonzero(volumes < MIN_VOLUME)
+    print(str(len(small_wells)) + " well(s) below the " + str(MIN_VOLUME) + " ul the p300 can dispense, " +
+          "the picklist check will reject them")
+    for i in small_wells[:LISTED_WELLS]:
+        print("  " + names[i] + ": " + "{:.1f}".format(volumes[i]) + " ul")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,8 @@
+import hashlib
 import json
 import math
-from opentrons import protocol_api
+import os
+import time
 
 metadata = {
     "protocolName": "Omega RxnPlus PCR clean up M1386 ",
@@ -15,299 +17,1317 @@ def get_values(*names):
     dict1 = dict()
 
     dict1["sample_number"] = 96
+    dict1["columns"] = None  # First well of each column to clean up, e.g. ["A4"]. None runs the first sample_number/8 columns
+    dict1["output_columns"] = None  # First well of each output column, None uses the same columns as the samples
     dict1["PCR_volume"] = 50
     dict1["bead_ratio"] = 1.8
     dict1["elution_vol"] = 50
     dict1["mag_delay"] = 6  # How long will the magnet be active
     dict1["Incubattion_time"] = 0.5
+    dict1["add_beads"] = True  # False when the magnetic beads are added by hand on the bench
+    dict1["wash_number"] = 2  # Number of 150ul ethanol washes
+    dict1["zspeed"] = 25  # Z speed limit in mm/s while the tips move in and out of the samples
+    # The supernatant and the ethanol are taken off in stages: the bulk in one aspiration per rate but the last,
+    # each at its rate times the aspirate flow rate from removal_depth mm below the level it leaves, then the last
+    # finish_volume ul at the last rate next to the pellet. A single rate takes all of it in one finishing pass at
+    # that rate, None takes each off in one pass at the plain flow rate
+    dict1["removal_rates"] = (2, 1.5, 1, 0.5)
+    dict1["finish_volume"] = 25
+    # The level is worked out from an estimated well shape, so the tips go well below it
+    dict1["removal_depth"] = 3
+
+    # Steps PCR_Purification_Omega_magbind_8wells.py runs differently. Mixes of each binding and elution column as
+    # (minutes waited before the mix, number of mixes, ul for the elution, height above the bottom in mm), the
+    # binding mixes Mix_vol. Mixes after a wait use the column's tip again. Waits need pipelined False, binding waits
+    # need batch_plates 1 and elution waits unattended False
+    dict1["binding_mixes"] = [(0, 15, 1)]
+    dict1["elution_mixes"] = [(0, 10, 40, 1), (0, 10, 45, 0.5)]
+    dict1["supernatant_left"] = 5  # ul of PCR and beads the supernatant removal leaves on the pellet
+    # Last of the ethanol taken off after the final wash as (ul, height above the bottom in mm), each in a trip of
+    # its own. With removal_rates the volume is taken in the trip of the final wash
+    dict1["last_ethanol_passes"] = [(30, 0.5)]
+    dict1["fresh_ethanol_tips"] = False  # True gives every ethanol wash its own tips
+    dict1["prewet_number"] = 5  # Ethanol pre-wetting trips of the tip before the second wash
+    # Air gaps in ul after the ethanol aspiration from the reservoir, after each ethanol removal and in the output transfer
+    dict1["air_gaps"] = {"ethanol add": 0, "ethanol removal": 0, "output": 10}
+
+    # Pipelined mode: every column is its own job, so the required waits overlap the pipetting of other columns
+    dict1["pipelined"] = False
+    # Minimum and maximum minutes between adding a reagent to a column and its next step, None uses Incubattion_time
+    dict1["dwell_times"] = {"binding": (None, 30), "ethanol": (0.5, 3), "elution": (None, 30)}
+    dict1["move_seconds"] = 5  # Gantry and tip handling time of one column step, used to model elapsed time in simulation
+
+    # Deck layout
+    dict1["tiprack_type"] = "opentrons_96_tiprack_300ul"
+    dict1["tiprack_slots"] = ["3", "4", "5", "6"]  # Only as many racks as the columns need are loaded
+    dict1["reagent_slot"] = "7"  # usascientific 12 well reservoir
+    # A reagent well or a list of wells, e.g. ["A1", "A2"], taken one after the other when a well runs out
+    dict1["bead_well"] = "A1"
+    dict1["elution_well"] = "A3"
+    dict1["ethanol_slot"] = "9"  # agilent 1 well reservoir, None takes the ethanol from ethanol_well of the reagent reservoir
+    dict1["ethanol_well"] = "A5"
+    dict1["waste_slot"] = "8"
+    # Volume in ml filled into each well of a reagent before the run, checked against what the run needs. Fill exactly
+    # these volumes: the tips follow the liquid level worked out from them
+    dict1["reagent_volumes"] = {"magbeads": 15, "ethanol": 100, "elution buffer": 10}
+
+    # Multi-dispense: one aspiration from the reservoir serves as many columns as fit into the tips.
+    # The disposal volume stays in the tips and is blown back into the reservoir after the last column. The ethanol
+    # drips from the tips, so it keeps one as well and the 300ul tips take one 150ul dose per trip.
+    dict1["multi_dispense"] = True
+    dict1["disposal_volumes"] = {"magbeads": 20, "ethanol": 20, "elution buffer": 20}
+
+    # JSON lines timing log of real runs, read by Simulation/timing_report.py. None turns it off
+    dict1["timing_log"] = "/data/user_storage/timing_log.jsonl"
+    # Labware definitions built by Simulation/labware_cache.py, e.g. "/data/user_storage/labware_cache.json".
+    # None loads the labware from the robot's own library
+    dict1["labware_cache"] = None
+    # Progress of a real run. A restarted run with the same settings skips the columns and phases that are done
+    # and only needs the reagents that are still to be added. None turns it off
+    dict1["checkpoint"] = "/data/user_storage/pcr_clean_up_checkpoint.json"
+
+    # Batch mode: number of PCR plates cleaned up one after the other in one run. The next plate waits on
+    # staging_slot and gets its beads and mixing while the current plate sits on the magnet or incubates.
+    dict1["batch_plates"] = 1
+    dict1["staging_slot"] = "11"
+
+    # Unattended mode: no operator pauses for drying and heating. The beads air-dry on the magnet for dry_time
+    # minutes and the elution buffer is taken pre-heated from heated_buffer_type on the 55 C temperature module,
+    # one column of buffer per sample column, filled with elution_vol + heated_buffer_extra ul per well.
+    dict1["unattended"] = False
+    dict1["dry_time"] = 5
+    dict1["heated_buffer_type"] = "opentrons_96_aluminumblock_nest_wellplate_100ul"
+    dict1["heated_buffer_extra"] = 10
 
     _all_values = dict1
 
     return [_all_values[n] for n in names]
 
 
-def run(protocol_context):
+def read_labware_cache(filename):
 
-    # PCR clean up kit: Omega RxnPlus PCR clean up #M1386
-    # This protocol is designed for all 96-wells of PCR plate
-    # Runtime for this protocl is 2-3 hours
+    # Labware definitions by load name from the cache Simulation/labware_cache.py builds, the latest version of
+    # each. Without the file every labware comes from the robot's labware library as usual.
+    if not filename or not os.path.exists(filename):
+        return dict()
+    with open(filename) as cache_file:
+        entries = sorted(json.load(cache_file)["labware"].values(), key=lambda entry: entry["version"])
+    return dict((entry["definition"]["parameters"]["loadName"], entry["definition"]) for entry in entries)
 
-    [sample_number, PCR_volume, bead_ratio, elution_vol, mag_delay, Incubattion_time] = get_values(
-        "sample_number", "PCR_volume", "bead_ratio", "elution_vol", "mag_delay", "Incubattion_time"
-    )
 
-    mag_deck = protocol_context.load_module("magnetic module gen2", "1")
-    mag_deck.disengage()
+def reagent_wells(names):
+    # A well name or a list of well names as a list
+    return names if isinstance(names, list) else [names]
 
-    temp_mod = protocol_context.load_module("temperature module gen2", "10")
-    temp_mod.set_temperature(55)  # set the temperature to 55 C
- 
-    mag_plate = mag_deck.load_labware("nest_96_wellplate_100ul_pcr_full_skirt")
-    output_plate = protocol_context.load_labware("nest_96_wellplate_100ul_pcr_full_skirt", "2", "Output")
-   
-   
-    # Define reagents and liquid waste
 
-    reagent_container = protocol_context.load_labware("usascientific_12_reservoir_22ml", "7", "reagent reservoir")
-    MagBeads = reagent_container.wells_by_name()["A1"]
-    Elution_buffer = reagent_container.wells_by_name()["A3"]
+def load_labware(parent, cache, load_name, location=None, label=None):
 
+    # Load labware on the deck, or on a module when `parent` is a module and there is no location,
+    # from its cached definition when the cache has one
+    definition = cache.get(load_name)
+    if location is None:
+        if definition:
+            return parent.load_labware_from_definition(definition, label)
+        return parent.load_labware(load_name, label)
+    if definition:
+        return parent.load_labware_from_definition(definition, location, label)
+    return parent.load_labware(load_name, location, label)
 
-    E_container = protocol_context.load_labware("agilent_1_reservoir_290ml", "9", "Etahnol reservoir")
-    Ethanol_container = E_container.wells_by_name()['A1']
-    
-    w_container = protocol_context.load_labware("agilent_1_reservoir_290ml", "8", "Liquid Waste")
-    Waste_container   =  w_container.wells_by_name()['A1']
 
+def liquid_seconds(volume, flow_rate, repetitions=1):
+    # Time the plunger needs to aspirate and dispense `volume` at `flow_rate`, `repetitions` times
+    return repetitions * 2.0 * volume / flow_rate
 
-    ###############################################################################
-    #tiprack_num = 4  # Number of tipracks being used
-    #slots = ["3", "4", "5", "6"][:tiprack_num]
-    # Since, I need to reset the tipracks in this run, declaring them this way is helpful later.
 
-    tiprack_1 = protocol_context.load_labware('opentrons_96_tiprack_300ul', 3)
-    tiprack_2 = protocol_context.load_labware('opentrons_96_tiprack_300ul', 4)
-    tiprack_3 = protocol_context.load_labware('opentrons_96_tiprack_300ul', 5)
-    tiprack_4 = protocol_context.load_labware('opentrons_96_tiprack_300ul', 6)
-    tipracks = [tiprack_1, tiprack_2, tiprack_3, tiprack_4]
+# Sample wells as truncated cones: diameter at the rim and at the bottom and depth in mm. The bottom diameter is
+# an estimate that makes the well hold about 200 ul, the definition only gives the rim.
+WELL_SHAPES = {
+    "nest_96_wellplate_100ul_pcr_full_skirt": (5.34, 3.0, 14.78),
+}
 
-    # load pipette with tip racks
-    pipette = protocol_context.load_instrument("p300_multi_gen2", "left", tip_racks=tipracks)
 
-    col_num = math.ceil(sample_number / 8) 
-    samples = [col for col in mag_plate.rows()[0][:col_num]]    
-    samples_top = [well.top() for well in mag_plate.rows()[0][:col_num]]
-    output = [col for col in output_plate.rows()[0][:col_num]]
-    ##########################################################################################
+def mix_rounds(mixes):
 
-    bead_vol = int(PCR_volume * bead_ratio)
-    Mix_vol = (bead_vol + PCR_volume - 20)
-    transfer1 = (PCR_volume + bead_vol)
-    counter = 0
-    zspeed = 25
+    # Split `mixes`, each starting with the minutes to wait before it, into (minutes, mixes) rounds that each
+    # start with a wait, so the mixes of one round share one tip pick-up
+    rounds = []
+    for mix in mixes:
+        if mix[0] or not rounds:
+            rounds.append((mix[0], []))
+        rounds[-1][1].append(mix[1:])
+    return rounds
 
-    ##### REAGENTS AMOUNT REQUIRED #### 
-    total_beads =  math.ceil((bead_vol * (sample_number+10))/1000) + 2
-    Total_Ethanol = math.ceil((150 * (sample_number+10))/1000) + 2
-    Total_Elution =  math.ceil((50 * (sample_number+10))/1000) + 2
-    protocol_context.comment(' Make sure that you have filled more than the volume required for finishing all assays')
-    protocol_context.comment(' Magnetic Beads buffer :-  ' +str(total_beads)+' ml')
-    protocol_context.comment(' Total Ethanol :-  ' + str(Total_Ethanol)+' ml')
-    protocol_context.comment(' Total Elution buffer :-  ' + str(Total_Elution)+ ' ml')
 
-    protocol_context.pause()
-    protocol_context.comment('Press resume if reagents volumes are enough for the assay')
+def liquid_height(shape, volume):
 
+    # Height in mm of `volume` ul above the bottom of a well of `shape`, by bisection of the cone's volume
+    top, bottom, depth = shape
 
-    ############## ADD MAGNETIC BEADS ##########
-    pipette.reset_tipracks()
-    pipette.starting_tip = tiprack_1.well('A1')
+    def volume_at(height):
+        radius = bottom / 2 + (top - bottom) / 2 * height / depth
+        return math.pi * height / 3 * ((bottom / 2) ** 2 + bottom / 2 * radius + radius ** 2)
 
-    pipette.flow_rate.aspirate = 200
-    pipette.flow_rate.dispense = 200
-    pipette.pick_up_tip()
-    protocol_context.comment("Adding magbeads to PCR ")
+    low, high = 0.0, depth
+    for i in range(30):
+        middle = (low + high) / 2
+        if volume_at(middle) < volume:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def removal_stages(fill_volume, volume, finish_volume, rates):
+
+    # Volume and rate of the stages that take `volume` ul out of a well holding `fill_volume` ul: the bulk until
+    # `finish_volume` ul are left, split evenly over the rates but the last, then the rest at the last rate.
+    # More than the fill takes the air above the pellet too. A single rate takes everything in the finish.
+    if len(rates) < 2:
+        return [(volume, rates[-1])]
+    bulk = max(min(volume, fill_volume) - finish_volume, 0)
+    steps = len(rates) - 1
+    parts = [round(bulk / steps)] * (steps - 1)
+    parts.append(bulk - sum(parts))
+    return [(part, rate) for part, rate in zip(parts, rates) if part] + [(volume - bulk, rates[-1])]
+
+
+def remove_liquid(pipette, well, shape, fill_volume, volume, finish_volume, finish_height, rates, depth):
+
+    # Aspirate `volume` ul out of `well` in the stages of removal_stages. Every bulk stage comes from `depth` mm
+    # below the level it leaves, so the tips step down with the level and slow down as they near the pellet.
+    # The finish comes slowly from `finish_height` above the bottom.
+    stages = removal_stages(fill_volume, volume, finish_volume, rates)
+    left = fill_volume
+    for bulk, bulk_rate in stages[:-1]:
+        left = left - bulk
+        height = max(liquid_height(shape, left) - depth, finish_height)
+        pipette.aspirate(bulk, well.bottom(height), rate = bulk_rate)
+    finish, finish_rate = stages[-1]
+    if finish:
+        pipette.aspirate(finish, well.bottom(finish_height), rate = finish_rate)
+
+
+# Reservoirs the reagents are taken from: inner area of one well in mm2, capacity in ul and the dead volume in ul
+# that stays behind once the tips reach their lowest aspiration height
+RESERVOIRS = {
+    "usascientific_12_reservoir_22ml": (8.33 * 71.88, 22000, 1500),
+    "agilent_1_reservoir_290ml": (108.0 * 72.0, 290000, 10000),
+}
 
-    for target in samples:
 
-        if counter == 0:
-            pipette.mix(10, 200, MagBeads.bottom(5))  # Mix the meagbead solution
+class LiquidTracker:
+
+    # Keeps the remaining volume of every reagent well and aspirates a few mm below the liquid surface,
+    # so the tips follow the level down instead of dipping to a fixed height. A reagent may fill several
+    # wells, which are taken one after the other: an aspiration that would reach into the dead volume of
+    # the current well comes from the next one. plan() adds up what the run will take of a reagent and
+    # check() rejects the run before it starts when its wells would run dry.
+
+    def __init__(self, protocol_context, immersion=3):
+        self._protocol_context = protocol_context
+        self._immersion = immersion
+        self.wells = dict()
+        self.restored = False
+
+    def add(self, name, wells, load_name, volume_ml, min_height):
+        # `wells` are the wells of the reagent in the order they are used, each filled with `volume_ml`
+        area, capacity, dead_volume = RESERVOIRS[load_name]
+        volume = volume_ml * 1000
+        if volume > capacity:
+            raise ValueError(str(volume_ml) + ' ml of ' + name + ' do not fit into ' + load_name)
+        self.wells[name] = dict(wells=wells, area=area, volumes=[volume] * len(wells), current=0,
+                                dead_volume=dead_volume, min_height=min_height, needed=0)
+
+    def plan(self, name, volume, channels=8):
+        self.wells[name]["needed"] += volume * channels
+
+    def check(self, max_aspiration):
+        # Every well but the last may keep up to one aspiration of `max_aspiration` ul above its dead volume,
+        # when the next aspiration does not fit any more
+        short = []
+        for name, reagent in self.wells.items():
+            if not reagent["needed"]:
+                continue
+            wells = len(reagent["wells"]) - reagent["current"]
+            needed = reagent["needed"] + reagent["dead_volume"] * wells + max_aspiration * (wells - 1)
+            loaded = sum(reagent["volumes"][reagent["current"]:])
+            self._protocol_context.comment(' ' + name + ' :-  ' + str(math.ceil(needed / 100) / 10) + ' ml needed, ' +
+                                           str(loaded / 1000) + ' ml loaded')
+            if needed > loaded:
+                short.append(name + ' (' + str(math.ceil(needed / 100) / 10) + ' ml)')
+        if short:
+            raise ValueError('Not enough reagent for this run: ' + ', '.join(short))
+
+    def fill_message(self):
+        # The volumes the operator fills in. The aspiration heights are worked out from them, a well filled with
+        # less than its volume would have the tips aspirate above the liquid. A resumed run goes on from the volumes
+        # an earlier run left, so nothing is refilled.
+        preposition = ' in ' if self.restored else ' into '
+        volumes = ', '.join(str(volume / 1000) + ' ml ' + name + preposition + str(well)
+                            for name, reagent in self.wells.items() if reagent["needed"]
+                            for well, volume in zip(reagent["wells"], reagent["volumes"]))
+        if self.restored:
+            return 'Leave the reservoirs as they are, the run goes on from ' + volumes + ', then resume'
+        return 'Fill exactly ' + volumes + ', then resume'
+
+    def volumes(self):
+        return dict((name, reagent["volumes"]) for name, reagent in self.wells.items())
+
+    def restore(self, volumes):
+        # Go on from the volumes an earlier run saved, from the first well that was not emptied
+        for name, saved in volumes.items():
+            reagent = self.wells[name]
+            reagent["volumes"] = list(saved)
+            while (reagent["current"] < len(saved) - 1 and
+                   reagent["volumes"][reagent["current"]] <= reagent["dead_volume"]):
+                reagent["current"] = reagent["current"] + 1
+        self.restored = True
+
+    def select(self, name, volume, channels=8):
+        # Move on to the next well when the current one cannot give `volume` per channel above its dead volume.
+        # Returns True when the run moved to another well
+        reagent = self.wells[name]
+        current = reagent["current"]
+        while (reagent["current"] < len(reagent["wells"]) - 1 and
+               reagent["volumes"][reagent["current"]] - volume * channels < reagent["dead_volume"]):
+            reagent["current"] = reagent["current"] + 1
+        return reagent["current"] != current
+
+    def well(self, name):
+        # The well the reagent is taken from now
+        reagent = self.wells[name]
+        return reagent["wells"][reagent["current"]]
+
+    def location(self, name, volume=0):
+        # Aspiration height in the current well once `volume` ul have been taken out, never below min_height
+        reagent = self.wells[name]
+        height = (reagent["volumes"][reagent["current"]] - volume) / reagent["area"] - self._immersion
+        return self.well(name).bottom(max(height, reagent["min_height"]))
+
+    def aspirate_from(self, name, volume, channels=8):
+        # Location to aspirate `volume` per channel, the volume is taken off the well
+        self.select(name, volume, channels)
+        location = self.location(name, volume * channels)
+        reagent = self.wells[name]
+        reagent["volumes"][reagent["current"]] -= volume * channels
+        return location
+
+
+class MotionProfile:
+
+    # The Z speed limit and the flow rates of one pipette as the protocol wants them. A setting is only sent
+    # to the hardware when it differs from the one in effect, so loops can state the settings of every step
+    # without repeating the same settings calls for every column.
+
+    def __init__(self, protocol_context, pipette):
+        self._protocol_context = protocol_context
+        self._pipette = pipette
+        self._z_speed = None  # None is the robot's default Z speed
+        self._flow_rates = {"aspirate": pipette.flow_rate.aspirate, "dispense": pipette.flow_rate.dispense}
+        self.requested = 0
+        self.sent = 0
+
+    def z_speed(self, speed):
+        # Limit the Z speed to `speed` mm/s, None goes back to the default speed
+        self.requested = self.requested + 1
+        if speed == self._z_speed:
+            return
+        if speed is None:
+            del self._protocol_context.max_speeds['Z']
         else:
-            pipette.mix(1, 200, MagBeads.bottom(5))
-        counter = counter + 1
-        
-        pipette.transfer(bead_vol, MagBeads.bottom(5), target.top(-1), new_tip="never")  # 1. Add magbead buffer to PC
-        
-    pipette.return_tip()  # return to original position
-    #pipette.drop_tip()   # for testing no need to drop tip
+            self._protocol_context.max_speeds['Z'] = speed
+        self._z_speed = speed
+        self.sent = self.sent + 1
+
+    def flow_rates(self, aspirate, dispense):
+        for name, rate in (("aspirate", aspirate), ("dispense", dispense)):
+            self.requested = self.requested + 1
+            if self._flow_rates[name] != rate:
+                setattr(self._pipette.flow_rate, name, rate)
+                self._flow_rates[name] = rate
+                self.sent = self.sent + 1
+
+    def summary(self):
+        return (str(self.sent) + ' of ' + str(self.requested) + ' speed and flow rate settings sent, ' +
+                str(self.requested - self.sent) + ' unchanged settings skipped')
+
+
+def plan_trips(items, dose, max_volume, disposal_volume):
+
+    # Split `items` into reservoir trips of as many `dose`s as fit into `max_volume` next to the disposal
+    # volume. A max_volume of None gives one dose per trip.
+    if max_volume is None:
+        return [[item] for item in items]
+    if dose + disposal_volume > max_volume:
+        raise ValueError(str(dose) + ' ul and a ' + str(disposal_volume) + ' ul disposal volume do not fit into ' +
+                         str(max_volume) + ' ul tips')
+    per_trip = int((max_volume - disposal_volume) // dose)
+    return [items[k:k + per_trip] for k in range(0, len(items), per_trip)]
+
+
+def tipracks_needed(group_number, col_num):
+    # Every (sample column, phase group) pair gets its own column of tips
+    return math.ceil(group_number * col_num / 12)
+
+
+class TipLedger:
+
+    # Assigns one column of tips to every (phase group, sample column) pair and picks it up and returns it
+    # at that position, so the tip racks are never reset and walked again. It counts how often every tip is
+    # used and what it touched, and refuses to let a tip touch the samples of more than one column.
+
+    def __init__(self, pipette, tipracks, groups, columns):
+        tip_columns = [column[0] for rack in tipracks for column in rack.columns()]
+        self._pipette = pipette
+        self._current = None
+        self._tip_columns = tip_columns
+        self._picked = set()
+        self.tip_columns_used = 0
+        self.tips = dict()
+        self.uses = dict()
+        self.touched = dict()
+        for group in groups:
+            self.add_group(group, len(columns))
+
+    def add_group(self, group, count):
+        # Assigns the next `count` free tip columns to `group`
+        first = len(self.tips)
+        for c in range(count):
+            key = (group, c)
+            self.tips[key] = self._tip_columns[first + c]
+            self.uses[key] = 0
+            self.touched[key] = set()
+
+    def new_racks(self):
+        # The operator replaced the tip racks, every position holds a fresh tip again
+        self._picked = set()
+        for key in self.touched:
+            self.touched[key] = set()
+
+    def pick_up(self, group, column, *touches):
+
+        # Pick up the tip of `group` for the column with index `column`. `touches` lists what the tip is
+        # going to touch, e.g. "magbeads", "waste" or "sample A4".
+        key = (group, column)
+        samples = set(name for name in self.touched[key] if name.startswith("sample"))
+        for name in touches:
+            if name.startswith("sample") and samples and name not in samples:
+                raise ValueError('The ' + group + ' tip of column ' + str(column + 1) + ' already touched ' +
+                                 ', '.join(sorted(samples)) + ' and would now touch ' + name)
+
+        self._pipette.pick_up_tip(self.tips[key])
+        if key not in self._picked:
+            self._picked.add(key)
+            self.tip_columns_used = self.tip_columns_used + 1
+        self.uses[key] = self.uses[key] + 1
+        self.touched[key].update(touches)
+        self._current = key
+
+    def return_tip(self):
+        self._pipette.return_tip()
+        self._current = None
+
+    def summary(self):
+        uses = sum(self.uses.values())
+        return (str(self.tip_columns_used) + ' tip columns used ' + str(uses) + ' times, ' +
+                str(round(uses / max(self.tip_columns_used, 1), 1)) + ' uses per tip column')
+
+
+class ColumnClock:
+
+    # Remembers when each column finished a step, so a required wait only covers the part of it that
+    # has not already passed while other columns were pipetted. On the robot this is the real clock.
+    # In simulation nothing takes time, so the elapsed time is modeled from the pipetting that was done.
+
+    def __init__(self, protocol_context):
+        self._context = protocol_context
+        self._simulating = protocol_context.is_simulating()
+        self._started = time.monotonic()
+        self._modeled = 0.0
+        self.marks = dict()
+
+    def now(self):
+        if self._simulating:
+            return self._modeled
+        return time.monotonic() - self._started
+
+    def spend(self, seconds):
+        self._modeled = self._modeled + seconds
+
+    def delay(self, seconds):
+        # A plain delay, counted on the modeled clock as well
+        if seconds > 0:
+            self._context.delay(seconds=seconds)
+            self._modeled = self._modeled + seconds
+
+    def mark(self, phase, column):
+        self.marks.setdefault(phase, dict())[column] = self.now()
+
+    def wait(self, phase, minimum, maximum, columns=None):
+
+        # Delay until the columns (all marked columns by default) have waited `minimum` minutes since their
+        # mark for `phase`. Returns the seconds delayed and the seconds of waiting that overlapped pipetting.
+        # Columns without a mark, which an earlier run finished, are not waited for.
+        marks = self.marks.get(phase, dict())
+        if columns is None:
+            columns = list(marks)
+        columns = [column for column in columns if column in marks]
+        if not columns:
+            return 0, 0
+
+        now = self.now()
+        remaining = max(minimum * 60 - (now - marks[column]) for column in columns)
+        if remaining > 0:
+            self._context.delay(seconds=remaining)
+            self._modeled = self._modeled + remaining
+
+        longest = self.now() - min(marks[column] for column in columns)
+        if longest > maximum * 60:
+            self._context.comment("Warning: a column waited " + str(round(longest / 60, 1)) + " minutes for " + phase +
+                                  ", more than the " + str(maximum) + " minutes allowed")
+
+        return max(remaining, 0), minimum * 60 - max(remaining, 0)
+
+
+# Positions of the volume and location arguments of the pipette calls the step log records
+LOGGED_CALLS = {
+    "aspirate": (0, 1), "dispense": (0, 1), "mix": (1, 2), "transfer": (0, 2), "air_gap": (0, None),
+    "blow_out": (None, 0), "touch_tip": (None, 0), "pick_up_tip": (None, 0), "return_tip": (None, None),
+    "drop_tip": (None, 0),
+}
 
-    pipette.reset_tipracks()
-    pipette.starting_tip = tiprack_1.well('A1')
 
-    protocol_context.comment("Mixing magbeads with PCR ")
+def describe_location(location):
+    # "A1 of reagent reservoir on 7" for a well or a location in a well
+    target = getattr(location, "labware", location)
+    return str(getattr(target, "object", target))
 
-    for target in samples:
 
-        pipette.flow_rate.aspirate = 100
-        pipette.flow_rate.dispense = 100
-        pipette.pick_up_tip()
-        
-        protocol_context.max_speeds['Z'] = zspeed
-        pipette.mix(15, Mix_vol, target.bottom(1))  # Mix the resuspension soln
-        del protocol_context.max_speeds['Z']
+class StepLog:
 
-        pipette.return_tip()  # No need to discard these tips right now, these will be re-used
-        #pipette.drop_tip()
+    # Timing log of a real run: every phase and every liquid handling call of a wrapped pipette becomes one
+    # JSON line with its phase, well, action, volume and start and end time. Each line is appended to the
+    # log file as soon as it is logged, so a run that is stopped keeps its log up to the last call.
+    # Nothing is logged while the protocol is simulated or analyzed.
+
+    def __init__(self, protocol_context, filename):
+        self.enabled = filename is not None and not protocol_context.is_simulating()
+        self._filename = filename
+        self._run = time.strftime("%Y%m%d-%H%M%S")
+        self._phase = "setup"
+        self._phase_start = time.time()
+
+    def phase(self, name):
+        # End the current phase and start phase `name`
+        if not self.enabled:
+            return
+        now = time.time()
+        self._add({"event": "phase", "phase": self._phase, "start": self._phase_start, "end": now})
+        self._phase = name
+        self._phase_start = now
 
+    def step(self, action, start, end, location=None, volume=None):
+        self._add({"event": "step", "phase": self._phase, "action": action, "start": start, "end": end,
+                   "well": describe_location(location) if location is not None else None, "volume": volume})
 
-    protocol_context.delay(minutes=Incubattion_time)  # Incubate for XX minutes
-    protocol_context.comment("Incubating for  5  minutes")
+    def wrap(self, pipette):
+        # The pipette itself when nothing is logged, otherwise a stand-in that logs its liquid handling calls
+        return LoggedPipette(pipette, self) if self.enabled else pipette
 
-    mag_deck.engage()  # the height of magnetic module is adjusted automatically
+    def _add(self, event):
+        event["run"] = self._run
+        with open(self._filename, "a") as log_file:
+            log_file.write(json.dumps(event) + "\n")
 
-    protocol_context.delay(minutes=mag_delay)  # wait for 5 min then mix slowly
-    protocol_context.comment("Magnetic module turned on and incubating for  " + str(mag_delay) + "   minutes  " )
+    def close(self):
+        self.phase("end")
 
-    ############# REMOVE SUPERNATANT #################
-    protocol_context.comment("  Removing supernatant ")
-    pipette.reset_tipracks()
-    pipette.starting_tip = tiprack_1.well('A1')
 
-    for target in samples:
-        pipette.flow_rate.aspirate = 50
-        pipette.flow_rate.dispense = 200
-        pipette.pick_up_tip()
-        
-        protocol_context.max_speeds['Z'] = zspeed
-        pipette.aspirate((transfer1-5), target.bottom(1), rate = 1)        
-        del protocol_context.max_speeds['Z']
+class LoggedPipette:
 
-        pipette.dispense(transfer1, Waste_container.bottom(30), rate = 1)
-        pipette.blow_out(Waste_container)
-        pipette.blow_out(Waste_container)
+    # Forwards everything to the pipette and reports the calls in LOGGED_CALLS to the step log
 
-        pipette.return_tip()
-        #pipette.drop_tip()
+    def __init__(self, pipette, log):
+        object.__setattr__(self, "_pipette", pipette)
+        object.__setattr__(self, "_log", log)
 
-    #################### ETHANOL WASH #######################
-    protocol_context.comment("Add 150ul 70ethanol twice and subsequently discard it ")
-    
+    def __setattr__(self, name, value):
+        setattr(self._pipette, name, value)
 
-    for i in range(2):
+    def __getattr__(self, name):
+        attribute = getattr(self._pipette, name)
+        if name not in LOGGED_CALLS:
+            return attribute
 
-        pipette.reset_tipracks()
-        pipette.starting_tip = tiprack_2.well('A1')
+        volume_index, location_index = LOGGED_CALLS[name]
 
-        pipette.flow_rate.aspirate = 100
-        pipette.flow_rate.dispense = 100
-        pipette.pick_up_tip()
+        def logged(*args, **kwargs):
+            start = time.time()
+            result = attribute(*args, **kwargs)
+            volume = args[volume_index] if volume_index is not None and len(args) > volume_index else kwargs.get("volume")
+            location = args[location_index] if location_index is not None and len(args) > location_index else kwargs.get("location")
+            self._log.step(name, start, time.time(), location, volume)
+            return result
 
-        counter2 = 0
+        return logged
 
-        for target in samples:
 
-            if (i == 1) and (counter2 == 0):
-                for j in range(5):
-                    pipette.transfer(200, Ethanol_container, Waste_container, new_tip='never', air_gap= 10)
-                counter2 = counter2 + 1
+class Checkpoint:
 
-            pipette.aspirate(150, Ethanol_container.bottom(4), rate = 1)
+    # Progress of a real run in a JSON file: the steps that are done (columns or phases of a plate) and the
+    # reagent volumes left in the reservoirs. The file is rewritten after every completed step. A run with the
+    # same settings that starts while the file is there skips the steps that are done; the file is removed when
+    # the run finishes. The tips need no record, every tip has its fixed position in the TipLedger and goes back there.
+    # Nothing is read or written while the protocol is simulated or analyzed.
 
-            protocol_context.max_speeds['Z'] = zspeed            
-            pipette.dispense(150, target.top(-1), rate = 1)
-            del protocol_context.max_speeds['Z']
+    def __init__(self, protocol_context, filename, key):
+        self.enabled = filename is not None and not protocol_context.is_simulating()
+        self._filename = filename
+        self._key = key
+        self._done = set()
+        self._volumes = None
+        self._liquids = None
+        if self.enabled and os.path.exists(filename):
+            with open(filename) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if state["key"] == key:
+                self._done = set(state["done"])
+                self._volumes = state.get("volumes")
+                protocol_context.comment('Resuming from ' + filename + ': ' + str(len(self._done)) + ' steps are done')
 
-        pipette.return_tip()
+    def __contains__(self, step):
+        return step in self._done
+
+    def complete(self, step):
+        self._done.add(step)
+        self._save()
+
+    def _save(self):
+        if not self.enabled:
+            return
+        # Written next to the checkpoint and renamed, so an abort never leaves half a file behind
+        volumes = self._liquids.volumes() if self._liquids else None
+        with open(self._filename + ".tmp", "w") as checkpoint_file:
+            json.dump({"key": self._key, "done": sorted(self._done), "volumes": volumes}, checkpoint_file)
+        os.replace(self._filename + ".tmp", self._filename)
+
+    def track(self, liquids):
+        # Save the volumes `liquids` keeps with every step, a resumed run starts from the saved volumes
+        self._liquids = liquids
+        if self._volumes:
+            liquids.restore(self._volumes)
+
+    def finish(self):
+        if self.enabled and os.path.exists(self._filename):
+            os.remove(self._filename)
 
-        pipette.reset_tipracks()
-        pipette.starting_tip = tiprack_2.well('A1')
-       
-        for target in samples:            
-            pipette.flow_rate.aspirate = 50
-            pipette.flow_rate.dispense = 100
-            pipette.pick_up_tip()
 
-            protocol_context.max_speeds['Z'] = zspeed 
-            pipette.aspirate(140, target.bottom(3), rate = 1)
-            del protocol_context.max_speeds['Z']
+def run(protocol_context):
 
-            pipette.dispense(140, Waste_container.bottom(30), rate = 1)
-            protocol_context.delay(minutes=0.02)
-            pipette.blow_out(Waste_container)
-            
-            if i == 1:
-                protocol_context.max_speeds['Z'] = zspeed 
-                pipette.aspirate(30, target.bottom(0.5), rate = 0.5)
-                del protocol_context.max_speeds['Z']
-
-                pipette.dispense(30, Waste_container.bottom(30), rate = 1)
-                protocol_context.delay(minutes=0.02)
-                pipette.blow_out(Waste_container)
-                                  
-            pipette.return_tip()  # return to original position
-            # pipette.drop_tip()  #for testing no need to drop tip
-        
+    # PCR clean up kit: Omega RxnPlus PCR clean up #M1386
+    # This protocol runs on any set of columns of the PCR plate, from a single column to all 96-wells.
+    # Every phase only visits the loaded columns, so partial plates take time in proportion to their size.
+    # Runtime for this protocl is 2-3 hours for all 96-wells
+    # Simulation/runtime_estimator.py estimates the machine time of each phase for a given set of values
+
+    [sample_number, columns, output_columns, PCR_volume, bead_ratio, elution_vol, mag_delay, Incubattion_time,
+     add_beads, wash_number, zspeed, removal_rates, finish_volume, removal_depth] = get_values(
+        "sample_number", "columns", "output_columns", "PCR_volume", "bead_ratio", "elution_vol", "mag_delay",
+        "Incubattion_time", "add_beads", "wash_number", "zspeed", "removal_rates", "finish_volume", "removal_depth"
+    )
 
-    protocol_context.comment("Advisable to let it dry at 55 C for >3 minutes " )
-     
-    mag_deck.disengage()
+    [tiprack_type, tiprack_slots, reagent_slot, bead_well, elution_well, ethanol_slot, ethanol_well, waste_slot] = get_values(
+        "tiprack_type", "tiprack_slots", "reagent_slot", "bead_well", "elution_well", "ethanol_slot", "ethanol_well", "waste_slot"
+    )
 
-    protocol_context.comment('Move to 55 C temp module for 5 minutes to dry off any residual ethanol')
-    protocol_context.comment('Put it back to magnetic plate when finished')
-    protocol_context.pause()
+    [pipelined, dwell_times, move_seconds, reagent_volumes, multi_dispense, disposal_volumes, timing_log] = get_values(
+        "pipelined", "dwell_times", "move_seconds", "reagent_volumes", "multi_dispense", "disposal_volumes", "timing_log"
+    )
 
+    [binding_mixes, elution_mixes, supernatant_left, last_ethanol_passes, fresh_ethanol_tips, prewet_number, air_gaps] = get_values(
+        "binding_mixes", "elution_mixes", "supernatant_left", "last_ethanol_passes", "fresh_ethanol_tips", "prewet_number",
+        "air_gaps"
+    )
 
-    ############### ELUTION #####################
-    protocol_context.comment("Add elution buffer and then incubate for 5 minutes ")
-    
-    pipette.reset_tipracks()
-    pipette.starting_tip = tiprack_3.well('A1')
-    pipette.flow_rate.aspirate = 50
-    pipette.flow_rate.dispense = 100
-    pipette.pick_up_tip()
+    [labware_cache, checkpoint_file] = get_values("labware_cache", "checkpoint")
 
-    for target in samples:
-        
-        pipette.aspirate(50, Elution_buffer.bottom(5), rate = 1)
-        protocol_context.max_speeds['Z'] = zspeed
-        pipette.dispense(50, target.top(-2), rate=1)
-        pipette.blow_out(target.top(-2))
-        del protocol_context.max_speeds['Z']
-    pipette.return_tip()
+    [batch_plates, staging_slot] = get_values("batch_plates", "staging_slot")
 
-    pipette.reset_tipracks()
-    pipette.starting_tip = tiprack_3.well('A1')
-    pipette.flow_rate.aspirate = 100
-    pipette.flow_rate.dispense = 100
+    [unattended, dry_time, heated_buffer_type, heated_buffer_extra] = get_values(
+        "unattended", "dry_time", "heated_buffer_type", "heated_buffer_extra"
+    )
 
+    # The phase names match the phases of Simulation/runtime_estimator.py
+    log = StepLog(protocol_context, timing_log)
+    cache = read_labware_cache(labware_cache)
 
-    for target in samples:
-        pipette.pick_up_tip()
+    mag_deck = protocol_context.load_module("magnetic module gen2", "1")
+    mag_deck.disengage()
 
-        protocol_context.max_speeds['Z'] = zspeed
-        pipette.mix(10, 40, target.bottom(1))
-        pipette.mix(10, 45, target.bottom(0.5))
+    temp_mod = protocol_context.load_module("temperature module gen2", "10")
+    if not unattended:
+        temp_mod.set_temperature(55)  # set the temperature to 55 C
+    if unattended:
+        heat_block = load_labware(temp_mod, cache, heated_buffer_type, label="Heated elution buffer")
+ 
+    mag_plate = load_labware(mag_deck, cache, "nest_96_wellplate_100ul_pcr_full_skirt")
+    sample_shape = WELL_SHAPES["nest_96_wellplate_100ul_pcr_full_skirt"]
+    output_plate = load_labware(protocol_context, cache, "nest_96_wellplate_100ul_pcr_full_skirt", "2", "Output")
+    if batch_plates > 1:
+        staging_plate = load_labware(protocol_context, cache, "nest_96_wellplate_100ul_pcr_full_skirt", staging_slot, "Next plate")
+   
+   
+    # Define reagents and liquid waste
 
-        del protocol_context.max_speeds['Z']
+    reagent_container = load_labware(protocol_context, cache, "usascientific_12_reservoir_22ml", reagent_slot, "reagent reservoir")
+    MagBeads = [reagent_container.wells_by_name()[name] for name in reagent_wells(bead_well)]
+    Elution_buffer = [reagent_container.wells_by_name()[name] for name in reagent_wells(elution_well)]
+
+    if ethanol_slot:
+        ethanol_type = "agilent_1_reservoir_290ml"
+        E_container = load_labware(protocol_context, cache, ethanol_type, ethanol_slot, "Etahnol reservoir")
+        Ethanol_container = [E_container.wells_by_name()['A1']]
+    else:
+        ethanol_type = "usascientific_12_reservoir_22ml"
+        Ethanol_container = [reagent_container.wells_by_name()[name] for name in reagent_wells(ethanol_well)]
+
+    # The lowest aspiration heights are the fixed heights the reagents were always taken from
+    liquids = LiquidTracker(protocol_context)
+    liquids.add("magbeads", MagBeads, "usascientific_12_reservoir_22ml", reagent_volumes["magbeads"], 5)
+    liquids.add("ethanol", Ethanol_container, ethanol_type, reagent_volumes["ethanol"], 4)
+    liquids.add("elution buffer", Elution_buffer, "usascientific_12_reservoir_22ml", reagent_volumes["elution buffer"], 5)
+    
+    w_container = load_labware(protocol_context, cache, "agilent_1_reservoir_290ml", waste_slot, "Liquid Waste")
+    Waste_container   =  w_container.wells_by_name()['A1']
 
-        pipette.return_tip()  # return to original position
-        # pipette.drop_tip()  #for testing no need to drop tip
+    ##################### WELLs TO PROCESS ###########################
+
+    if columns is None:
+        col_num = math.ceil(sample_number / 8)
+        columns = [well.well_name for well in mag_plate.rows()[0][:col_num]]
+    else:
+        col_num = len(columns)
+        sample_number = 8 * col_num
+    if output_columns is None:
+        output_columns = columns
+
+    samples = [mag_plate.wells_by_name()[name] for name in columns]
+    output = [output_plate.wells_by_name()[name] for name in output_columns]
+    staging_samples = []
+    if batch_plates > 1:
+        staging_samples = [staging_plate.wells_by_name()[name] for name in columns]
+
+    # Column k of the heated block holds the elution buffer of the k-th sample column, it is refilled between plates
+    heated_buffer = []
+    if unattended:
+        heated_buffer = heat_block.rows()[0]
+        if col_num > len(heated_buffer):
+            raise ValueError(str(col_num) + ' columns need ' + str(col_num) +
+                             ' columns of heated elution buffer but ' + heated_buffer_type + ' has ' +
+                             str(len(heated_buffer)))
+        if elution_vol + heated_buffer_extra > heated_buffer[0].max_volume:
+            raise ValueError(str(elution_vol + heated_buffer_extra) + ' ul of elution buffer do not fit into the wells of ' +
+                             heated_buffer_type)
 
+    ###############################################################################
+    # Tips are re-used by the same column in several phases, so every phase group gets one tip column
+    # per sample column: 1) magbeads, mixing and supernatant 2) ethanol washes, or every wash with
+    # fresh_ethanol_tips 3) elution 4) output transfer.
+    # The groups are packed one after the other over the racks and only the racks they fill are loaded.
+    # In batch mode the operator puts fresh tip racks on the deck at every plate change, so the racks only
+    # hold one plate. The staged columns of the next plate get their binding tips from a "staging" group
+    # in the tip columns left over, with a spare tip rack if a slot is free. The staged columns that do not
+    # fit are bound after the plate change.
+
+    ethanol_groups = ["ethanol " + str(i + 1) for i in range(wash_number)] if fresh_ethanol_tips else ["ethanol"]
+    tip_groups = ["binding"] + ethanol_groups + ["elution", "output"]
+    tiprack_num = tipracks_needed(len(tip_groups), col_num)
+    if tiprack_num > len(tiprack_slots):
+        raise ValueError(str(col_num) + ' columns need ' + str(tiprack_num) + ' tip racks but only ' +
+                         str(len(tiprack_slots)) + ' tiprack_slots are given')
+    staging_num = 0
+    if batch_plates > 1:
+        tiprack_num = max(tiprack_num, min(tipracks_needed(len(tip_groups) + 1, col_num), len(tiprack_slots)))
+        staging_num = min(col_num, 12 * tiprack_num - len(tip_groups) * col_num)
+
+    tipracks = [load_labware(protocol_context, cache, tiprack_type, slot) for slot in tiprack_slots[:tiprack_num]]
+    protocol_context.comment(str(col_num) + ' columns need ' + str(tiprack_num) + ' tip rack(s) on slot(s) ' +
+                             ', '.join(tiprack_slots[:tiprack_num]))
 
-    protocol_context.delay(minutes=Incubattion_time)
-    
-    temp_mod.set_temperature(55)
-    protocol_context.comment("Transfer to heating plate 55 C for ~2 min ")
-    protocol_context.comment('Put it back to magnetic plate when finished')
-    protocol_context.pause()
+    # load pipette with tip racks
+    pipette = log.wrap(protocol_context.load_instrument("p300_multi_gen2", "left", tip_racks=tipracks))
+    tips = TipLedger(pipette, tipracks, tip_groups, columns)
+    if staging_num:
+        tips.add_group("staging", staging_num)
+    motion = MotionProfile(protocol_context, pipette)
+
+    # The trips are sized to the tips, which hold less than the pipette with e.g. 200 ul filter tips
+    tip_volume = min(pipette.max_volume, tipracks[0].wells()[0].max_volume)
+    trip_volume = tip_volume if multi_dispense else None
+    if not multi_dispense:
+        disposal_volumes = dict((name, 0) for name in disposal_volumes)
+    ##########################################################################################
+
+    bead_vol = int(PCR_volume * bead_ratio)
+    Mix_vol = (bead_vol + PCR_volume - 20)
+    transfer1 = (PCR_volume + bead_vol)
+    counter = 0
+    prewet_volume = min(200, tip_volume - 10)  # Next to the 10 ul air gap
+
+    doses = [("ethanol", 150 + air_gaps["ethanol add"])]
+    if add_beads:
+        doses.append(("magbeads", bead_vol))
+    if not unattended:
+        doses.append(("elution buffer", elution_vol))
+    for name, dose in doses:
+        if dose + disposal_volumes[name] > tip_volume:
+            raise ValueError(str(dose) + ' ul of ' + name + ' and a ' + str(disposal_volumes[name]) +
+                             ' ul disposal volume do not fit into ' + str(tip_volume) + ' ul tips')
+
+    clock = ColumnClock(protocol_context)
+    binding_min, binding_max = dwell_times["binding"]
+    ethanol_min, ethanol_max = dwell_times["ethanol"]
+    elution_min, elution_max = dwell_times["elution"]
+    if binding_min is None:
+        binding_min = Incubattion_time
+    if elution_min is None:
+        elution_min = Incubattion_time
+
+    binding_rounds = mix_rounds(binding_mixes)
+    elution_rounds = mix_rounds(elution_mixes)
+    if binding_rounds[0][0] or len(binding_rounds) > 1:
+        if pipelined or batch_plates > 1:
+            raise ValueError('Waits in binding_mixes need pipelined False and batch_plates 1')
+    if elution_rounds[0][0] or len(elution_rounds) > 1:
+        if pipelined or unattended:
+            raise ValueError('Waits in elution_mixes need pipelined False and unattended False')
+    binding_mix_number = sum(mixes for minutes, mixes, height in binding_mixes)
+
+    # A restart with the same settings skips the steps an earlier run finished. The steps are named by
+    # plate, phase and column, e.g. "plate 1 supernatant A4" or "plate 2 ethanol add 1 A4".
+    key = hashlib.sha256(json.dumps([columns, output_columns, PCR_volume, bead_ratio, elution_vol, add_beads, wash_number,
+                                     pipelined, multi_dispense, batch_plates, unattended, fresh_ethanol_tips,
+                                     prewet_number]).encode()).hexdigest()
+    checkpoint = Checkpoint(protocol_context, checkpoint_file, key)
+    checkpoint.track(liquids)
+
+    def step(plate, phase, j=None):
+        return "plate " + str(plate + 1) + " " + phase + ("" if j is None else " " + columns[j])
+
+    def to_do(plate, phase):
+        # Column indices of the plate that still need `phase`
+        return [j for j in range(col_num) if step(plate, phase, j) not in checkpoint]
 
-    protocol_context.comment("Turn on magnets, wait for beads to settle ")
+    ##### REAGENTS AMOUNT REQUIRED #### 
+    # Every aspiration of the 8-channel takes its volume from the reservoir 8 times. All plates of a batch
+    # share the reservoirs, so they are checked for the whole batch, for the steps that are not done yet.
+    if add_beads:
+        liquids.plan("magbeads", bead_vol * sum(len(to_do(plate, "beads")) for plate in range(batch_plates)))
+    for plate in range(batch_plates):
+        for i in range(wash_number):
+            liquids.plan("ethanol", 150 * len(to_do(plate, "ethanol add " + str(i + 1))))
+        if wash_number > 1 and to_do(plate, "ethanol add 2"):
+            # Pre-wetting the tips before the second wash
+            liquids.plan("ethanol", prewet_number * prewet_volume)
+    if not unattended:
+        liquids.plan("elution buffer", elution_vol * sum(len(to_do(plate, "elution buffer")) for plate in range(batch_plates)))
+
+    liquids.check(8 * tip_volume)
+    if batch_plates > 1:
+        protocol_context.comment("Batch of " + str(batch_plates) + " plates, put plate 2 on slot " + staging_slot)
+    if unattended:
+        protocol_context.comment("Fill columns 1 to " + str(col_num) + " of the heated block on slot 10 with " +
+                                 str(elution_vol + heated_buffer_extra) + " ul elution buffer per well")
+
+    log.phase("operator pause")
+    protocol_context.pause(liquids.fill_message())
+
+
+    # Batch mode: while a plate is on the magnet or incubates, the next plate on the staging slot gets its beads
+    # and mixing column by column. `staged` holds these columns as (estimated seconds, job).
+    bind_seconds = move_seconds + liquid_seconds(Mix_vol, 100, binding_mix_number)
+    if add_beads:
+        bind_seconds = bind_seconds + liquid_seconds(200, 200) + liquid_seconds(bead_vol, 200)
+    staged = []
+
+    # Unattended mode: the heated block only warms up from the final ethanol wash on, the buffer does not
+    # sit at 55 C for the whole run
+    heating = False
+
+    def start_heating():
+        nonlocal heating
+        if not heating:
+            temp_mod.start_set_temperature(55)
+            heating = True
+
+    def sample_name(plate, j):
+        # What the tips of column j touch on plate `plate`, the tip ledger keeps them apart
+        if batch_plates == 1:
+            return "sample " + columns[j]
+        return "sample " + columns[j] + " of plate " + str(plate + 1)
+
+    def bind_column(plate, j, target, tip=None):
+
+        # Add the beads to one column and mix it right away with the column's own binding tip, or with
+        # the staging tip `tip` for a column of the next plate
+        nonlocal counter
+        group, tip_column = tip or ("binding", j)
+        tips.pick_up(group, tip_column, "magbeads", sample_name(plate, j))
+
+        if add_beads and step(plate, "beads", j) not in checkpoint:
+            motion.flow_rates(aspirate=200, dispense=200)
+            fresh_well = liquids.select("magbeads", bead_vol)
+            reservoir_mixes = 10 if counter == 0 or fresh_well else 1  # The beads settle until the first column of a well
+            counter = counter + 1
+            pipette.mix(reservoir_mixes, 200, liquids.location("magbeads", 200 * 8))  # Mix the meagbead solution
+            pipette.transfer(bead_vol, liquids.aspirate_from("magbeads", bead_vol), target.top(-1), new_tip="never")
+            checkpoint.complete(step(plate, "beads", j))
+            clock.spend(liquid_seconds(200, 200, reservoir_mixes) + liquid_seconds(bead_vol, 200))
+
+        motion.flow_rates(aspirate=100, dispense=100)
+        motion.z_speed(zspeed)
+        for minutes, mixes, height in binding_mixes:
+            pipette.mix(mixes, Mix_vol, target.bottom(height))  # Mix the resuspension soln
+        motion.z_speed(None)
+
+        tips.return_tip()  # No need to discard these tips right now, these will be re-used
+        checkpoint.complete(step(plate, "binding", j))
+        clock.spend(move_seconds + liquid_seconds(Mix_vol, 100, binding_mix_number))
+        clock.mark("binding", plate * col_num + j)
+
+    def idle(minutes):
+
+        # Wait `minutes`, doing staged columns of the next plate first as long as they fit into the wait
+        deadline = clock.now() + minutes * 60
+        while staged and clock.now() + staged[0][0] <= deadline:
+            seconds, job = staged.pop(0)
+            job()
+        clock.delay(deadline - clock.now())
+
+    for plate in range(batch_plates):
+
+        first = plate * col_num
+        plate_columns = list(range(first, first + col_num))
+        if not to_do(plate, "output"):
+            continue  # Finished by an earlier run
+
+        if plate > 0:
+            # This plate got its beads on the staging slot, finish the columns that did not fit into the waits
+            protocol_context.comment("Plate " + str(plate + 1) + " of " + str(batch_plates))
+            for seconds, job in staged:
+                job()
+            staged = []
+
+            protocol_context.comment("Move plate " + str(plate) + " off the magnetic module and put plate " +
+                                     str(plate + 1) + " from slot " + staging_slot + " onto it, put an empty output " +
+                                     "plate on slot 2" + (" and plate " + str(plate + 2) + " on slot " + staging_slot
+                                                          if plate + 1 < batch_plates else ""))
+            protocol_context.comment("Replace the tip racks on slot(s) " + ', '.join(tiprack_slots[:tiprack_num]) +
+                                     " with full ones" + (", refill columns 1 to " + str(col_num) +
+                                                          " of the heated block" if unattended else ""))
+            if step(plate, "plate change") not in checkpoint:
+                log.phase("operator pause")
+                protocol_context.pause()
+                checkpoint.complete(step(plate, "plate change"))
+            tips.new_racks()
+
+        if plate + 1 < batch_plates:
+            staged = [(bind_seconds, lambda next_plate=plate + 1, j=j, k=k: bind_column(next_plate, j, staging_samples[j],
+                                                                                        ("staging", k)))
+                      for k, j in enumerate(to_do(plate + 1, "binding")[:staging_num])]
+
+        ############## ADD MAGNETIC BEADS ##########
+        if plate > 0:
+            log.phase("binding")
+            protocol_context.comment("Binding plate " + str(plate + 1) + " on the magnetic module ")
+            for j in to_do(plate, "binding"):  # Columns an earlier run did not bind on the staging slot
+                bind_column(plate, j, samples[j])
+            waited, overlapped = clock.wait("binding", binding_min, binding_max, plate_columns)
+            protocol_context.comment("Binding: waited " + str(round(waited)) + " s, " + str(round(overlapped)) +
+                                     " s of the incubation overlapped pipetting")
+
+        elif pipelined:
+            # Each column gets its beads and is mixed right away with its own tip,
+            # so its binding time runs while the next columns are pipetted
+            log.phase("bead add and mixing")
+            protocol_context.comment("Adding magbeads and mixing column by column ")
+
+            for j in to_do(plate, "binding"):
+                bind_column(plate, j, samples[j])
+
+            waited, overlapped = clock.wait("binding", binding_min, binding_max, plate_columns)
+            protocol_context.comment("Binding: waited " + str(round(waited)) + " s, " + str(round(overlapped)) +
+                                     " s of the incubation overlapped pipetting")
+
+        else:
+            bead_columns = to_do(plate, "beads")
+            if add_beads and bead_columns:
+                log.phase("bead add")
+                motion.flow_rates(aspirate=200, dispense=200)
+                tips.pick_up("binding", 0, "magbeads")  # Dispenses from the top, so one tip serves all columns
+                protocol_context.comment("Adding magbeads to PCR ")
+
+                disposal = disposal_volumes["magbeads"]
+                trips = plan_trips(bead_columns, bead_vol, trip_volume, disposal)
+                for trip in trips:
+
+                    if liquids.select("magbeads", bead_vol * len(trip)) or counter == 0:  # First trip from a well
+                        pipette.mix(10, 200, liquids.location("magbeads", 200 * 8))  # Mix the meagbead solution
+                    else:
+                        pipette.mix(1, 200, liquids.location("magbeads", 200 * 8))
+                    counter = counter + 1
+                    
+                    # 1. Add magbead buffer to PCR, the disposal volume goes back to the reservoir
+                    pipette.aspirate(bead_vol * len(trip) + disposal, liquids.aspirate_from("magbeads", bead_vol * len(trip)))
+                    for j in trip:
+                        pipette.dispense(bead_vol, samples[j].top(-1))
+                        checkpoint.complete(step(plate, "beads", j))
+                    if disposal:
+                        pipette.blow_out(liquids.well("magbeads").top())
+                    
+                tips.return_tip()  # return to original position
+                protocol_context.comment("Magbead reservoir trips: " + str(len(trips)) + " for " + str(len(bead_columns)) + " columns")
+                #pipette.drop_tip()   # for testing no need to drop tip
+
+            log.phase("mixing")
+            protocol_context.comment("Mixing magbeads with PCR ")
+
+            binding_columns = to_do(plate, "binding")
+            for r, (minutes, mixes) in enumerate(binding_rounds):
+                if minutes and binding_columns:
+                    idle(minutes)
+                for j in binding_columns:
+                    target = samples[j]
+
+                    motion.flow_rates(aspirate=100, dispense=100)
+                    tips.pick_up("binding", j, sample_name(plate, j))
+                    
+                    motion.z_speed(zspeed)
+                    for mix_number, height in mixes:
+                        pipette.mix(mix_number, Mix_vol, target.bottom(height))  # Mix the resuspension soln
+                    motion.z_speed(None)
+
+                    tips.return_tip()  # No need to discard these tips right now, these will be re-used
+                    if r == len(binding_rounds) - 1:
+                        checkpoint.complete(step(plate, "binding", j))
+                    #pipette.drop_tip()
+
+            log.phase("incubation")
+            protocol_context.comment("Incubating for  " + str(Incubattion_time) + "  minutes")
+            idle(Incubattion_time)  # Incubate for XX minutes
+
+        mag_deck.engage()  # the height of magnetic module is adjusted automatically
+
+        log.phase("incubation")
+        protocol_context.comment("Magnetic module turned on and incubating for  " + str(mag_delay) + "   minutes  " )
+        idle(mag_delay)  # wait for 5 min then mix slowly
+
+        ############# REMOVE SUPERNATANT #################
+        log.phase("supernatant removal")
+        protocol_context.comment("  Removing supernatant ")
+
+        for j in to_do(plate, "supernatant"):
+            target = samples[j]
+            motion.flow_rates(aspirate=50, dispense=200)
+            tips.pick_up("binding", j, sample_name(plate, j), "waste")
+            
+            motion.z_speed(zspeed)
+            if removal_rates:
+                remove_liquid(pipette, target, sample_shape, transfer1, transfer1 - supernatant_left, finish_volume, 1,
+                              removal_rates, removal_depth)
+            else:
+                pipette.aspirate((transfer1 - supernatant_left), target.bottom(1), rate = 1)        
+            motion.z_speed(None)
+
+            pipette.dispense(transfer1, Waste_container.bottom(30), rate = 1)
+            pipette.blow_out(Waste_container)
 
-    mag_deck.engage()
-    mag_delay = mag_delay + 2
-    protocol_context.delay(minutes = mag_delay)
+            tips.return_tip()
+            checkpoint.complete(step(plate, "supernatant", j))
+            #pipette.drop_tip()
+
+        #################### ETHANOL WASH #######################
+        protocol_context.comment("Add 150ul 70ethanol " + str(wash_number) + " times and subsequently discard it ")
+
+        # Ethanol is added to a batch of columns and then removed from the same columns. In pipelined mode the
+        # batch is as large as the maximum ethanol dwell allows, otherwise all columns form one batch. Each removal
+        # waits for the minimum dwell. The add and the removal are checkpointed per column, a resumed
+        # run never adds ethanol to a column that still holds the ethanol of the same wash.
+        ethanol_add_seconds = move_seconds + liquid_seconds(150, 100)
+        last_volume = sum(volume for volume, height in last_ethanol_passes)
+
+        def ethanol_remove_seconds(last_wash):
+            # The final wash also takes the last of the ethanol, in the same trip or in trips of their own
+            if removal_rates:
+                removed = 140 + last_volume if last_wash else 140
+                return (move_seconds + removed / 100 + 1.2 +
+                        sum(volume / (50 * rate) for volume, rate in
+                            removal_stages(150, removed, finish_volume, removal_rates)))
+            seconds = move_seconds + 140 / 50 + 140 / 100 + 1.2
+            if last_wash:
+                seconds = seconds + sum(volume / 25 + volume / 100 + 1.2 for volume, height in last_ethanol_passes)
+            return seconds
+
+        for i in range(wash_number):
+            adds = to_do(plate, "ethanol add " + str(i + 1))
+            removals = to_do(plate, "ethanol remove " + str(i + 1))
+            if not removals:
+                continue  # Finished by an earlier run
+
+            last_wash = i == wash_number - 1
+            remove_seconds = ethanol_remove_seconds(last_wash)
+            ethanol_batch = col_num
+            if pipelined:
+                ethanol_batch = 1
+                while (ethanol_batch < col_num and
+                       max((ethanol_batch + 1) * ethanol_add_seconds, ethanol_add_seconds + ethanol_batch * remove_seconds)
+                       <= ethanol_max * 60):
+                    ethanol_batch = ethanol_batch + 1
+
+            log.phase("ethanol wash " + str(i + 1))
+            protocol_context.comment("Ethanol wash " + str(i + 1))
+            if unattended and last_wash:
+                start_heating()
+
+            prewet = i == 1
+            ethanol_group = ethanol_groups[i] if fresh_ethanol_tips else "ethanol"
+            add_gap = air_gaps["ethanol add"]
+            for start in range(0, col_num, ethanol_batch):
+                batch = range(start, min(start + ethanol_batch, col_num))
+                batch_adds = [j for j in batch if j in adds]
+
+                if batch_adds:
+                    motion.flow_rates(aspirate=100, dispense=100)
+                    tips.pick_up(ethanol_group, 0, "ethanol", "waste")  # Dispenses from the top, so one tip serves all columns
+
+                    if prewet:
+                        for k in range(prewet_number):
+                            pipette.transfer(prewet_volume, liquids.aspirate_from("ethanol", prewet_volume), Waste_container,
+                                             new_tip='never', air_gap= 10)
+                        prewet = False
+
+                    disposal = disposal_volumes["ethanol"]
+                    # The air gap takes room in the tips and leaves with the first column of the trip
+                    for trip in plan_trips(batch_adds, 150, trip_volume and trip_volume - add_gap, disposal):
+                        pipette.aspirate(150 * len(trip) + disposal, liquids.aspirate_from("ethanol", 150 * len(trip)), rate = 1)
+                        if add_gap:
+                            pipette.air_gap(add_gap)
+
+                        motion.z_speed(zspeed)            
+                        for k, j in enumerate(trip):
+                            pipette.dispense(150 + (add_gap if k == 0 else 0), samples[j].top(-1), rate = 1)
+                            checkpoint.complete(step(plate, "ethanol add " + str(i + 1), j))
+                            clock.spend(ethanol_add_seconds)
+                            clock.mark("ethanol", first + j)
+                        motion.z_speed(None)
+                        if disposal:
+                            pipette.blow_out(liquids.well("ethanol").top())
+
+                    tips.return_tip()
+               
+                removal_gap = air_gaps["ethanol removal"]
+                for j in [j for j in batch if j in removals]:
+                    target = samples[j]
+                    clock.wait("ethanol", ethanol_min, ethanol_max, [first + j])
+
+                    motion.flow_rates(aspirate=50, dispense=100)
+                    tips.pick_up(ethanol_group, j, sample_name(plate, j), "waste")
+
+                    motion.z_speed(zspeed) 
+                    if removal_rates and last_wash and last_ethanol_passes:
+                        # The final wash takes the last of the ethanol near the pellet in the same trip
+                        removed = 140 + last_volume
+                        remove_liquid(pipette, target, sample_shape, 150, removed, finish_volume, last_ethanol_passes[-1][1],
+                                      removal_rates, removal_depth)
+                    elif removal_rates:
+                        removed = 140
+                        remove_liquid(pipette, target, sample_shape, 150, removed, finish_volume, 3, removal_rates,
+                                      removal_depth)
+                    else:
+                        removed = 140
+                        pipette.aspirate(140, target.bottom(3), rate = 1)
+                    if removal_gap:
+                        pipette.air_gap(removal_gap)
+                    motion.z_speed(None)
+
+                    pipette.dispense(removed + removal_gap, Waste_container.bottom(30), rate = 1)
+                    protocol_context.delay(minutes=0.02)
+                    pipette.blow_out(Waste_container)
+                    
+                    if last_wash and not removal_rates:  # Take off the last of the ethanol after the final wash
+                        for volume, height in last_ethanol_passes:
+                            motion.z_speed(zspeed) 
+                            pipette.aspirate(volume, target.bottom(height), rate = 0.5)
+                            if removal_gap:
+                                pipette.air_gap(removal_gap)
+                            motion.z_speed(None)
+
+                            pipette.dispense(volume + removal_gap, Waste_container.bottom(30), rate = 1)
+                            protocol_context.delay(minutes=0.02)
+                            pipette.blow_out(Waste_container)
+                                          
+                    tips.return_tip()  # return to original position
+                    checkpoint.complete(step(plate, "ethanol remove " + str(i + 1), j))
+                    # pipette.drop_tip()  #for testing no need to drop tip
+                    clock.spend(remove_seconds)
+            
 
-    pipette.reset_tipracks()
-    pipette.starting_tip = tiprack_4.well('A1')
-    pipette.flow_rate.aspirate = 50
-    pipette.flow_rate.dispense = 50
-    
-    out_vol = (elution_vol - 5)
+        if unattended:
+            # The beads dry on the magnet instead of the 55 C temp module, the next plate's binding may run meanwhile
+            if step(plate, "drying") not in checkpoint:
+                log.phase("drying")
+                protocol_context.comment("Air-drying on the magnetic module for " + str(dry_time) + " minutes ")
+                idle(dry_time)
+                checkpoint.complete(step(plate, "drying"))
+            mag_deck.disengage()
 
-    for target, dest in zip(samples, output):
+        else:
+            protocol_context.comment("Advisable to let it dry at 55 C for >3 minutes " )
+             
+            mag_deck.disengage()
+
+            if step(plate, "drying") not in checkpoint:
+                protocol_context.comment('Move to 55 C temp module for 5 minutes to dry off any residual ethanol')
+                protocol_context.comment('Put it back to magnetic plate when finished')
+                log.phase("operator pause")
+                protocol_context.pause()
+                checkpoint.complete(step(plate, "drying"))
+
+
+        ############### ELUTION #####################
+        log.phase("elution")
+        if unattended:
+            start_heating()  # A resumed run may have skipped the final wash
+            temp_mod.await_temperature(55)
+        if pipelined or unattended:
+            # Each column gets its elution buffer and is mixed right away with its own tip. The heated buffer
+            # of the unattended mode comes from the column's own column of the heated block.
+            protocol_context.comment("Add elution buffer and mix column by column ")
+
+            for j in to_do(plate, "elution"):
+                target = samples[j]
+                tips.pick_up("elution", j, "elution buffer", sample_name(plate, j))
+                if step(plate, "elution buffer", j) not in checkpoint:
+                    motion.flow_rates(aspirate=50, dispense=100)
+                    if unattended:
+                        source = heated_buffer[j].bottom(1)
+                    else:
+                        source = liquids.aspirate_from("elution buffer", elution_vol)
+                    pipette.aspirate(elution_vol, source, rate = 1)
+
+                    motion.z_speed(zspeed)
+                    pipette.dispense(elution_vol, target.top(-2), rate=1)
+                    checkpoint.complete(step(plate, "elution buffer", j))
+                    pipette.blow_out(target.top(-2))
+                else:
+                    motion.z_speed(zspeed)
+
+                motion.flow_rates(aspirate=100, dispense=100)
+                for minutes, mixes, volume, height in elution_mixes:
+                    pipette.mix(mixes, volume, target.bottom(height))
+                motion.z_speed(None)
+
+                tips.return_tip()
+                checkpoint.complete(step(plate, "elution", j))
+                clock.spend(move_seconds + elution_vol / 50 + elution_vol / 100 +
+                            sum(liquid_seconds(volume, 100, mixes) for minutes, mixes, volume, height in elution_mixes))
+                clock.mark("elution", first + j)
+
+            waited, overlapped = clock.wait("elution", elution_min, elution_max, plate_columns)
+            protocol_context.comment("Elution: waited " + str(round(waited)) + " s, " + str(round(overlapped)) +
+                                     " s of the incubation overlapped pipetting")
 
-        pipette.pick_up_tip()
+        else:
+            protocol_context.comment("Add elution buffer and then incubate for 5 minutes ")
+            
+            buffer_columns = to_do(plate, "elution buffer")
+            if buffer_columns:
+                motion.flow_rates(aspirate=50, dispense=100)
+                tips.pick_up("elution", 0, "elution buffer")  # Dispenses from the top, so one tip serves all columns
+
+                disposal = disposal_volumes["elution buffer"]
+                trips = plan_trips(buffer_columns, elution_vol, trip_volume, disposal)
+                for trip in trips:
+                    
+                    pipette.aspirate(elution_vol * len(trip) + disposal, liquids.aspirate_from("elution buffer", elution_vol * len(trip)),
+                                     rate = 1)
+                    motion.z_speed(zspeed)
+                    for j in trip:
+                        pipette.dispense(elution_vol, samples[j].top(-2), rate=1)
+                        checkpoint.complete(step(plate, "elution buffer", j))
+                    if not disposal:
+                        pipette.blow_out(samples[trip[-1]].top(-2))
+                    motion.z_speed(None)
+                    if disposal:
+                        pipette.blow_out(liquids.well("elution buffer").top())  # Return the disposal volume to the reservoir
+                tips.return_tip()
+                protocol_context.comment("Elution buffer reservoir trips: " + str(len(trips)) + " for " + str(len(buffer_columns)) +
+                                         " columns")
+
+            motion.flow_rates(aspirate=100, dispense=100)
+
+
+            elution_columns = to_do(plate, "elution")
+            for r, (minutes, mixes) in enumerate(elution_rounds):
+                if minutes and elution_columns:
+                    idle(minutes)
+                for j in elution_columns:
+                    target = samples[j]
+                    tips.pick_up("elution", j, sample_name(plate, j))
+
+                    motion.z_speed(zspeed)
+                    for mix_number, volume, height in mixes:
+                        pipette.mix(mix_number, volume, target.bottom(height))
+
+                    motion.z_speed(None)
+
+                    tips.return_tip()  # return to original position
+                    if r == len(elution_rounds) - 1:
+                        checkpoint.complete(step(plate, "elution", j))
+                    # pipette.drop_tip()  #for testing no need to drop tip
+
+
+            idle(Incubattion_time)
         
-        protocol_context.max_speeds['Z'] = zspeed
-        pipette.transfer(out_vol, target.bottom(1), dest.bottom(5), new_tip="never", air_gap=10)   
-        pipette.blow_out(dest.top(-5))     
-        del protocol_context.max_speeds['Z']
+        if not unattended and step(plate, "heating") not in checkpoint:
+            temp_mod.set_temperature(55)
+            protocol_context.comment("Transfer to heating plate 55 C for ~2 min ")
+            protocol_context.comment('Put it back to magnetic plate when finished')
+            log.phase("operator pause")
+            protocol_context.pause()
+            checkpoint.complete(step(plate, "heating"))
+
+        log.phase("output transfer")
+        protocol_context.comment("Turn on magnets, wait for beads to settle ")
+
+        mag_deck.engage()
+        idle(mag_delay + 2)
+
+        motion.flow_rates(aspirate=50, dispense=50)
+        
+        out_vol = (elution_vol - 5)
+
+        for j in to_do(plate, "output"):
+            target = samples[j]
+            dest = output[j]
+
+            tips.pick_up("output", j, sample_name(plate, j), "output " + output_columns[j])
+            
+            motion.z_speed(zspeed)
+            pipette.transfer(out_vol, target.bottom(1), dest.bottom(5), new_tip="never", air_gap=air_gaps["output"])   
+            checkpoint.complete(step(plate, "output", j))
+            pipette.blow_out(dest.top(-5))     
+            motion.z_speed(None)
 
-        pipette.return_tip()
-       
+            tips.return_tip()
+           
 
     mag_deck.disengage()
     temp_mod.deactivate()
     protocol_context.home() 
+    protocol_context.comment("Tips: " + tips.summary())
+    protocol_context.comment("Motion: " + motion.summary())
+    checkpoint.finish()
+    log.close()
     protocol_context.comment("Finished")
 
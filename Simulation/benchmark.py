@@ -0,0 +1,191 @@
+import argparse
+import collections
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from recording_context import load_protocol, override_values, RecordingContext
+from runtime_estimator import estimate, parse_overrides
+
+
+# Offline benchmark of the protocols in this repository.
+# Every case runs a protocol's run() against RecordingContext and reports the wall-clock time of the
+# simulation, its peak Python memory, the number of recorded commands of each kind and the estimated
+# robot runtime from runtime_estimator. The clean-up is swept over sample_number and runs the 8-well
+# procedure once, the cherrypicking protocols run over synthetic picklists of different sizes.
+# The results are written as JSON; --baseline compares them with an earlier results file.
+#
+# Usage:
+#   python Simulation/benchmark.py --output benchmark_results.json
+#   python Simulation/benchmark.py --output new.json --baseline benchmark_results.json
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLEAN_UP = os.path.join(ROOT, "PCR_Clean_up", "PCR_Purification_Omega_magbind_96wells.py")
+CLEAN_UP_8 = os.path.join(ROOT, "PCR_Clean_up", "PCR_Purification_Omega_magbind_8wells.py")
+DILUTE_OLIGOS = os.path.join(ROOT, "Cherrypicking", "Dilute_Oligos_Opentrons_Cherrypicking.py")
+PRIMER_DILUTION = os.path.join(ROOT, "Cherrypicking", "Primer_dilution_10uM_Opentrons.py")
+
+SAMPLE_NUMBERS = list(range(8, 97, 8))
+PICKLIST_ROWS = [96, 384, 1536]
+# The primers go into one 384-well plate, and a larger picklist needs more tips than the deck holds
+PRIMER_ROWS = [96, 192, 384]
+
+# Commands reported in the summary table, every recorded command kind is counted in the JSON
+REPORTED_COMMANDS = ["aspirate", "dispense", "mix", "pick_up_tip", "return_tip", "max_speeds", "delay"]
+
+
+def well_names(rows, columns):
+    # Well names in column order: A1, B1, ... H1, A2, ...
+    return [chr(ord("A") + row) + str(column) for column in range(1, columns + 1) for row in range(rows)]
+
+
+def write_picklist(filename, header, rows):
+    with open(filename, "w", newline="") as picklist_file:
+        writer = csv.writer(picklist_file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def dilution_picklists(directory, rows):
+
+    # Water volumes for both oligo plates. The volumes are kept small so the largest picklists still fit
+    # into one water reservoir and into the 384-well plate.
+    generator = random.Random(rows)
+    for filename, wells in [("Picklist_Oligos_1.csv", well_names(8, 12)), ("Picklist_Oligos_2.csv", well_names(16, 24))]:
+        write_picklist(os.path.join(directory, filename), ["Destination Well", "Volume"],
+                       [(wells[i % len(wells)], generator.randint(20, 60)) for i in range(rows)])
+
+
+def primer_picklist(directory, rows):
+
+    # Plate-to-plate copies in column order, the layout the primer dilution is used for
+    wells = well_names(16, 24)
+    write_picklist(os.path.join(directory, "Picklist_primer_dilution.csv"), ["Source Well", "Destination Well"],
+                   [(wells[i % len(wells)], wells[i % len(wells)]) for i in range(rows)])
+
+
+def cases():
+
+    # (protocol path, case name, get_values() overrides, function writing the picklists or None)
+    for sample_number in SAMPLE_NUMBERS:
+        yield CLEAN_UP, "sample_number=" + str(sample_number), {"sample_number": sample_number}, None
+    yield CLEAN_UP_8, "columns=A4", {}, None
+    # Picklists larger than the plates visit their wells several times
+    for rows in PICKLIST_ROWS:
+        yield (DILUTE_OLIGOS, "rows=" + str(rows), {"water_volume": 290, "allow_duplicate_destinations": True},
+               lambda directory, rows=rows: dilution_picklists(directory, rows))
+    for rows in PRIMER_ROWS:
+        yield (PRIMER_DILUTION, "rows=" + str(rows), {"allow_duplicate_destinations": True},
+               lambda directory, rows=rows: primer_picklist(directory, rows))
+
+
+def run_case(path, overrides):
+
+    # Load and run one protocol, timing and tracing only the run itself
+    module = override_values(load_protocol(path), overrides)
+    context = RecordingContext()
+    status = "ok"
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        module.run(context)
+    except Exception as error:
+        status = type(error).__name__ + ": " + str(error)
+    wall_seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    phases, pauses = estimate(context.commands)
+    return {
+        "status": status,
+        "wall_seconds": round(wall_seconds, 4),
+        "peak_memory_bytes": peak_memory,
+        "commands": dict(collections.Counter(command["command"] for command in context.commands)),
+        "estimated_seconds": round(sum(seconds for phase, seconds in phases), 1),
+        "phases": dict((phase, round(seconds, 1)) for phase, seconds in phases),
+    }
+
+
+def benchmark(overrides=None):
+    results = []
+    for path, name, case_overrides, make_picklists in cases():
+        with tempfile.TemporaryDirectory() as directory:
+            values = dict(case_overrides)
+            values.update(overrides or {})
+            if make_picklists:
+                make_picklists(directory)
+                values["working_directory"] = directory
+            result = run_case(path, values)
+        result["protocol"] = os.path.relpath(path, ROOT)
+        result["case"] = name
+        results.append(result)
+    return results
+
+
+def key(result):
+    return result["protocol"] + " " + result["case"]
+
+
+def compare(results, baseline):
+
+    # Lines describing every case whose command counts, estimated runtime or status changed
+    old_results = dict((key(result), result) for result in baseline["results"])
+    changes = []
+    for result in results:
+        old = old_results.get(key(result))
+        if old is None:
+            changes.append(key(result) + ": new case")
+            continue
+        if old["status"] != result["status"]:
+            changes.append(key(result) + ": status " + old["status"] + " -> " + result["status"])
+        for name in sorted(set(old["commands"]) | set(result["commands"])):
+            before, after = old["commands"].get(name, 0), result["commands"].get(name, 0)
+            if before != after:
+                changes.append(key(result) + ": " + name + " " + str(before) + " -> " + str(after))
+        if abs(old["estimated_seconds"] - result["estimated_seconds"]) >= 1:
+            changes.append(key(result) + ": estimated minutes " + "{:.1f}".format(old["estimated_seconds"] / 60) +
+                           " -> " + "{:.1f}".format(result["estimated_seconds"] / 60))
+    return changes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the protocols offline over sample counts and picklist sizes")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="earlier results file to compare command counts and runtimes with")
+    parser.add_argument("--set", action="append", metavar="NAME=VALUE",
+                        help="override a get_values() entry in every protocol, can be given several times")
+    args = parser.parse_args(argv)
+
+    results = benchmark(parse_overrides(args.set))
+    with open(args.output, "w") as output_file:
+        json.dump({"python": sys.version.split()[0], "results": results}, output_file, indent=2)
+
+    print("{:<44}{:>10}{:>10}{:>10}".format("case", "wall s", "peak MB", "est min") +
+          "".join(name.rjust(12) for name in REPORTED_COMMANDS))
+    for result in results:
+        name = os.path.basename(result["protocol"])[:26] + " " + result["case"]
+        print("{:<44}{:>10.3f}{:>10.2f}{:>10.1f}".format(name, result["wall_seconds"], result["peak_memory_bytes"] / 1e6,
+                                                      result["estimated_seconds"] / 60) +
+              "".join(str(result["commands"].get(command, 0)).rjust(12) for command in REPORTED_COMMANDS))
+        if result["status"] != "ok":
+            print("    " + result["status"])
+    print("Results written to " + args.output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            changes = compare(results, json.load(baseline_file))
+        print(str(len(changes)) + " change(s) against " + args.baseline)
+        for change in changes:
+            print("  " + change)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
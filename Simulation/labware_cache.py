@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import sys
+
+from recording_context import definition_geometry, LABWARE, LABWARE_CACHE
+
+
+# Builds the labware cache: the definition of every labware the protocols load, as the opentrons package
+# ships it, together with its well layout, keyed by "load_name/version".
+# RecordingContext reads the layouts from Simulation/labware_cache.json, so the offline tools simulate the
+# library geometry without the opentrons package. Its LABWARE table only serves labware that is not cached. Copied to the robot as
+# /data/user_storage/labware_cache.json, the protocols load their labware from the cached definitions
+# instead of looking each one up in the labware library. Only building the cache needs the opentrons package.
+#
+# Usage:
+#   python Simulation/labware_cache.py
+#   python Simulation/labware_cache.py --labware opentrons_96_tiprack_20ul --output labware_cache.json
+
+
+# Labware loaded by the protocols in this repository besides the LABWARE table of recording_context
+PROTOCOL_LABWARE = [
+    "opentrons_96_aluminumblock_nest_wellplate_100ul",
+]
+
+
+def build(load_names, version=1):
+
+    # Cache entries of the load names from the labware library of the opentrons package
+    from opentrons_shared_data.labware import load_definition
+
+    labware = dict()
+    for load_name in load_names:
+        definition = load_definition(load_name, version)
+        labware[load_name + "/" + str(definition["version"])] = {
+            "version": definition["version"],
+            "geometry": definition_geometry(definition),
+            "definition": definition,
+        }
+    return labware
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the labware cache from the opentrons labware library")
+    parser.add_argument("--labware", action="append", metavar="LOAD_NAME",
+                        help="labware to add to the protocols' labware, can be given several times")
+    parser.add_argument("--version", type=int, default=1, help="definition version (default 1, as apiLevel 2.8 loads)")
+    parser.add_argument("--output", default=LABWARE_CACHE, help="cache file, defaults to Simulation/labware_cache.json")
+    args = parser.parse_args(argv)
+
+    load_names = sorted(set(list(LABWARE) + PROTOCOL_LABWARE + (args.labware or [])))
+    try:
+        labware = build(load_names, args.version)
+    except ImportError:
+        print("Building the labware cache needs the opentrons package: pip install opentrons")
+        return 1
+
+    with open(args.output, "w") as cache_file:
+        json.dump({"labware": labware}, cache_file, sort_keys=True, separators=(",", ":"))
+    print(str(len(labware)) + " labware definitions written to " + os.path.relpath(args.output))
+    for key in sorted(labware):
+        print("  " + key)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,575 @@
+import collections
+import importlib.util
+import json
+import math
+import os
+
+
+# Offline stand-in for the Opentrons protocol_context.
+# RecordingContext runs a protocol's run() without robot hardware or the opentrons package
+# and records every command the protocol issues, together with the gantry movement it causes
+# and the flow rate / speed that was in effect, so the commands can be counted and timed.
+
+
+class OutOfTipsError(Exception):
+    pass
+
+
+# Front-left corner of each OT-2 deck slot in mm
+SLOT_ORIGINS = {
+    "1": (0.0, 0.0), "2": (132.5, 0.0), "3": (265.0, 0.0),
+    "4": (0.0, 90.5), "5": (132.5, 90.5), "6": (265.0, 90.5),
+    "7": (0.0, 181.0), "8": (132.5, 181.0), "9": (265.0, 181.0),
+    "10": (0.0, 271.5), "11": (132.5, 271.5), "12": (265.0, 271.5),
+}
+
+# Well layout of the labware used by the protocols in this repository:
+# rows, columns, A1 x, A1 y, x pitch, y pitch, labware height, well depth, well max volume (uL)
+LABWARE = {
+    "nest_96_wellplate_100ul_pcr_full_skirt": (8, 12, 14.38, 74.24, 9.0, 9.0, 15.7, 14.78, 100),
+    "usascientific_96_wellplate_2.4ml_deep": (8, 12, 14.4, 74.2, 9.0, 9.0, 44.1, 41.3, 2400),
+    "nest_96_wellplate_2ml_deep": (8, 12, 14.3, 74.15, 9.0, 9.0, 41.0, 38.0, 2000),
+    "opentrons_96_aluminumblock_nest_wellplate_100ul": (8, 12, 14.38, 74.2, 9.0, 9.0, 21.2, 14.78, 100),
+    "corning_384_wellplate_112ul_flat": (16, 24, 12.12, 76.49, 4.5, 4.5, 14.22, 11.43, 112),
+    "agilent_1_reservoir_290ml": (1, 1, 63.88, 42.785, 0.0, 0.0, 44.04, 39.22, 290000),
+    "usascientific_12_reservoir_22ml": (1, 12, 13.94, 42.9, 9.09, 0.0, 44.45, 42.16, 22000),
+    "opentrons_96_tiprack_300ul": (8, 12, 14.38, 74.24, 9.0, 9.0, 64.49, 59.3, 300),
+    "opentrons_96_tiprack_20ul": (8, 12, 14.38, 74.24, 9.0, 9.0, 64.69, 39.2, 20),
+    "opentrons_96_filtertiprack_200ul": (8, 12, 14.38, 74.24, 9.0, 9.0, 64.49, 59.3, 200),
+    "opentrons_96_filtertiprack_20ul": (8, 12, 14.36, 74.26, 9.0, 9.0, 64.69, 39.2, 20),
+}
+
+# Labware cache written by labware_cache.py: the definitions and well layouts of library labware by
+# "load_name/version". Its layouts take priority over LABWARE, which only covers labware that is not cached
+LABWARE_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "labware_cache.json")
+
+# Height the labware sits above the deck when it is loaded on a module, in mm
+MODULE_HEIGHTS = {
+    "magnetic module gen2": 32.0,
+    "temperature module gen2": 9.0,
+}
+
+# channels, minimum volume, maximum volume, default aspirate / dispense / blow out flow rate (uL/s)
+PIPETTES = {
+    "p20_single_gen2": (1, 1, 20, 7.56, 7.56, 7.56),
+    "p20_multi_gen2": (8, 1, 20, 7.6, 7.6, 7.6),
+    "p300_single_gen2": (1, 20, 300, 92.86, 92.86, 132.86),
+    "p300_multi_gen2": (8, 20, 300, 94.0, 94.0, 94.0),
+}
+
+TRASH_POINT = (330.0, 310.0, 82.0)
+HOME_POINT = (418.0, 353.0, 205.0)
+TRAVEL_CLEARANCE = 10.0  # The gantry arcs this far above the tallest labware on the deck
+
+
+class Point(tuple):
+
+    def __new__(cls, x, y, z):
+        return tuple.__new__(cls, (x, y, z))
+
+    x = property(lambda self: self[0])
+    y = property(lambda self: self[1])
+    z = property(lambda self: self[2])
+
+
+class Location:
+
+    def __init__(self, point, labware):
+        self.point = Point(*point)
+        self.labware = labware
+
+    def __repr__(self):
+        return repr(self.labware) + " at z=" + str(round(self.point.z, 2))
+
+
+class Well:
+
+    def __init__(self, parent, name, x, y, bottom_z, depth, max_volume):
+        self.parent = parent
+        self.well_name = name
+        self.display_name = name + " of " + parent.name
+        self.depth = depth
+        self.max_volume = max_volume
+        self._x = x
+        self._y = y
+        self._bottom_z = bottom_z
+
+    def top(self, z=0.0):
+        return Location((self._x, self._y, self._bottom_z + self.depth + z), self)
+
+    def bottom(self, z=0.0):
+        return Location((self._x, self._y, self._bottom_z + z), self)
+
+    def center(self):
+        return Location((self._x, self._y, self._bottom_z + self.depth / 2), self)
+
+    def __repr__(self):
+        return self.display_name
+
+
+_cached_labware = None
+
+
+def cached_labware():
+    # The entries of the labware cache, read once per process
+    global _cached_labware
+    if _cached_labware is None:
+        _cached_labware = dict()
+        if os.path.exists(LABWARE_CACHE):
+            with open(LABWARE_CACHE) as cache_file:
+                _cached_labware = json.load(cache_file)["labware"]
+    return _cached_labware
+
+
+def definition_geometry(definition):
+
+    # The LABWARE entry of an Opentrons labware definition
+    ordering = definition["ordering"]
+    wells = definition["wells"]
+    a1 = wells[ordering[0][0]]
+    x_pitch = round(wells[ordering[1][0]]["x"] - a1["x"], 3) if len(ordering) > 1 else 0.0
+    y_pitch = round(a1["y"] - wells[ordering[0][1]]["y"], 3) if len(ordering[0]) > 1 else 0.0
+    return (len(ordering[0]), len(ordering), a1["x"], a1["y"], x_pitch, y_pitch, definition["dimensions"]["zDimension"],
+            a1["depth"], a1["totalLiquidVolume"])
+
+
+def labware_geometry(load_name, version=None):
+
+    # LABWARE entry of a load name, from the labware cache (the latest cached version unless `version`
+    # is given), which holds the library definitions, or else from the table
+    entries = [entry for key, entry in cached_labware().items()
+               if key.split("/")[0] == load_name and version in (None, entry["version"])]
+    if entries:
+        return tuple(max(entries, key=lambda entry: entry["version"])["geometry"])
+    if load_name in LABWARE:
+        return LABWARE[load_name]
+    raise KeyError('No offline geometry for labware "' + load_name + '", add it to LABWARE or build the ' +
+                   'labware cache with labware_cache.py')
+
+
+class Labware:
+
+    def __init__(self, load_name, slot, label=None, z_offset=0.0, geometry=None):
+        rows, columns, a1_x, a1_y, x_pitch, y_pitch, height, depth, max_volume = geometry or labware_geometry(load_name)
+        origin_x, origin_y = SLOT_ORIGINS[slot]
+
+        self.load_name = load_name
+        self.slot = slot
+        self.name = (label or load_name) + " on " + slot
+        self.height = height + z_offset
+        self._rows = []
+        for r in range(rows):
+            row = []
+            for c in range(columns):
+                name = chr(ord("A") + r) + str(c + 1)
+                row.append(Well(self, name, origin_x + a1_x + c * x_pitch, origin_y + a1_y - r * y_pitch,
+                                self.height - depth, depth, max_volume))
+            self._rows.append(row)
+
+    def rows(self):
+        return [list(row) for row in self._rows]
+
+    def columns(self):
+        return [list(column) for column in zip(*self._rows)]
+
+    def wells(self):
+        return [well for column in self.columns() for well in column]
+
+    def wells_by_name(self):
+        return dict((well.well_name, well) for well in self.wells())
+
+    def well(self, name):
+        return self.wells_by_name()[name]
+
+    def __getitem__(self, name):
+        return self.wells_by_name()[name]
+
+    def __repr__(self):
+        return self.name
+
+
+class Module:
+
+    def __init__(self, context, name, slot):
+        self._context = context
+        self.name = name
+        self.slot = slot
+        self.labware = None
+
+    def load_labware(self, load_name, label=None):
+        self.labware = self._context._add_labware(load_name, self.slot, label, MODULE_HEIGHTS.get(self.name, 0.0))
+        return self.labware
+
+    def load_labware_from_definition(self, definition, label=None):
+        self.labware = self._context._add_labware(definition["parameters"]["loadName"], self.slot, label,
+                                                  MODULE_HEIGHTS.get(self.name, 0.0), definition_geometry(definition))
+        return self.labware
+
+    def engage(self, height=None, offset=None, height_from_base=None):
+        self._context._record("engage", module=self.name)
+
+    def disengage(self):
+        self._context._record("disengage", module=self.name)
+
+    def set_temperature(self, celsius):
+        self._context._record("set_temperature", module=self.name, celsius=celsius)
+
+    def start_set_temperature(self, celsius):
+        self._context._record("start_set_temperature", module=self.name, celsius=celsius)
+
+    def await_temperature(self, celsius):
+        self._context._record("await_temperature", module=self.name, celsius=celsius)
+
+    def deactivate(self):
+        self._context._record("deactivate", module=self.name)
+
+
+class MaxSpeeds(dict):
+
+    def __init__(self, context):
+        dict.__init__(self)
+        self._context = context
+
+    def __setitem__(self, axis, speed):
+        dict.__setitem__(self, axis, speed)
+        self._context._record("max_speeds", axis=axis, speed=speed)
+
+    def __delitem__(self, axis):
+        dict.__delitem__(self, axis)
+        self._context._record("max_speeds", axis=axis, speed=None)
+
+
+class FlowRates:
+
+    def __init__(self, pipette, aspirate, dispense, blow_out):
+        object.__setattr__(self, "_pipette", pipette)
+        object.__setattr__(self, "aspirate", aspirate)
+        object.__setattr__(self, "dispense", dispense)
+        object.__setattr__(self, "blow_out", blow_out)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        self._pipette._context._record("flow_rate", pipette=self._pipette.mount, action=name, rate=value)
+
+
+class Pipette:
+
+    def __init__(self, context, name, mount, tip_racks):
+        channels, min_volume, max_volume, aspirate, dispense, blow_out = PIPETTES[name]
+
+        self._context = context
+        self.name = name
+        self.mount = mount
+        self.channels = channels
+        self.min_volume = min_volume
+        self.max_volume = max_volume
+        self.tip_racks = list(tip_racks or [])
+        self.flow_rate = FlowRates(self, aspirate, dispense, blow_out)
+        self.default_speed = 400.0
+        self.starting_tip = None
+        self.current_volume = 0.0
+        self.has_tip = False
+        self._used_tips = set()
+        self._tip_well = None
+
+    # Tip handling
+
+    def _next_tip(self):
+        started = self.starting_tip is None
+        for rack in self.tip_racks:
+            for column in rack.columns():
+                if not started and self.starting_tip in column:
+                    started = True
+                    column = column[column.index(self.starting_tip):]
+                if not started:
+                    continue
+                if self.channels == 1:
+                    for well in column:
+                        if id(well) not in self._used_tips:
+                            return well
+                elif len(column) == self.channels and all(id(well) not in self._used_tips for well in column):
+                    return column[0]
+        raise OutOfTipsError(self.name + " on " + self.mount + " mount has run out of tips")
+
+    def _tips_at(self, well):
+        if self.channels == 1:
+            return [well]
+        column = [column for column in well.parent.columns() if well in column][0]
+        return column[column.index(well):column.index(well) + self.channels]
+
+    def reset_tipracks(self):
+        self._used_tips = set()
+
+    def pick_up_tip(self, location=None):
+        if self.has_tip:
+            raise RuntimeError(self.name + " already has a tip attached")
+        well = location.labware if isinstance(location, Location) else location
+        if well is None:
+            well = self._next_tip()
+        for tip in self._tips_at(well):
+            self._used_tips.add(id(tip))
+        self._tip_well = well
+        self.has_tip = True
+        self._context._record("pick_up_tip", pipette=self.mount, location=well.top(), tips=self.channels)
+        return self
+
+    def return_tip(self):
+        if not self.has_tip:
+            raise RuntimeError(self.name + " has no tip to return")
+        # Like the robot, a returned tip stays used until the tip racks are reset
+        self._context._record("return_tip", pipette=self.mount, location=self._tip_well.top())
+        self.has_tip = False
+        self.current_volume = 0.0
+        return self
+
+    def drop_tip(self, location=None):
+        if not self.has_tip:
+            raise RuntimeError(self.name + " has no tip to drop")
+        self._context._record("drop_tip", pipette=self.mount, location=location, point=TRASH_POINT)
+        self.has_tip = False
+        self.current_volume = 0.0
+        return self
+
+    # Liquid handling
+
+    def _location(self, location, position="bottom"):
+        # A bare well means 1 mm above its bottom for liquid handling and its top for blow out
+        if isinstance(location, Well):
+            return location.bottom(1.0) if position == "bottom" else location.top()
+        return location
+
+    def aspirate(self, volume=None, location=None, rate=1.0):
+        if not self.has_tip:
+            raise RuntimeError("Cannot aspirate without a tip attached")
+        if volume is None:
+            volume = self.max_volume - self.current_volume
+        if self.current_volume + volume > self.max_volume + 1e-6:
+            raise RuntimeError("Cannot aspirate more than the " + str(self.max_volume) + " uL maximum volume")
+        self.current_volume = self.current_volume + volume
+        self._context._take(self._location(location), volume * self.channels)
+        self._context._record("aspirate", pipette=self.mount, volume=volume, location=self._location(location),
+                              flow_rate=self.flow_rate.aspirate * rate)
+        return self
+
+    def dispense(self, volume=None, location=None, rate=1.0):
+        if volume is None:
+            volume = self.current_volume
+        volume = min(volume, self.current_volume)
+        self.current_volume = self.current_volume - volume
+        self._context._take(self._location(location), -volume * self.channels)
+        self._context._record("dispense", pipette=self.mount, volume=volume, location=self._location(location),
+                              flow_rate=self.flow_rate.dispense * rate)
+        return self
+
+    def mix(self, repetitions=1, volume=None, location=None, rate=1.0):
+        if not self.has_tip:
+            raise RuntimeError("Cannot mix without a tip attached")
+        if volume is None:
+            volume = self.max_volume
+        self._context._record("mix", pipette=self.mount, repetitions=repetitions, volume=volume,
+                              location=self._location(location), aspirate_rate=self.flow_rate.aspirate * rate,
+                              dispense_rate=self.flow_rate.dispense * rate)
+        return self
+
+    def blow_out(self, location=None):
+        self._context._take(self._location(location, "top"), -self.current_volume * self.channels)
+        self.current_volume = 0.0
+        self._context._record("blow_out", pipette=self.mount, location=self._location(location, "top"),
+                              flow_rate=self.flow_rate.blow_out)
+        return self
+
+    def touch_tip(self, location=None, radius=1.0, v_offset=-1.0, speed=60.0):
+        self._context._record("touch_tip", pipette=self.mount, location=self._location(location, "top"))
+        return self
+
+    def air_gap(self, volume=None, height=None):
+        if volume is None:
+            volume = self.max_volume - self.current_volume
+        self.current_volume = self.current_volume + volume
+        self._context._record("air_gap", pipette=self.mount, volume=volume, flow_rate=self.flow_rate.aspirate)
+        return self
+
+    def move_to(self, location, force_direct=False, minimum_z_height=None, speed=None):
+        self._context._record("move_to", pipette=self.mount, location=self._location(location, "top"))
+        return self
+
+    # Complex liquid handling, broken down into the commands the robot would run
+
+    def transfer(self, volume, source, dest, new_tip="once", air_gap=0, blow_out=False,
+                 blowout_location=None, mix_before=None, mix_after=None, touch_tip=False, **kwargs):
+
+        sources = source if isinstance(source, list) else None
+        dests = dest if isinstance(dest, list) else None
+        count = max(len(sources or [0]), len(dests or [0]), len(volume) if isinstance(volume, list) else 1)
+        volumes = volume if isinstance(volume, list) else [volume] * count
+        sources = sources or [source] * count
+        dests = dests or [dest] * count
+
+        capacity = self.max_volume - air_gap
+        if new_tip == "once":
+            self.pick_up_tip()
+
+        for step_volume, step_source, step_dest in zip(volumes, sources, dests):
+            parts = max(1, math.ceil(step_volume / capacity))
+            for i in range(parts):
+                if new_tip == "always":
+                    self.pick_up_tip()
+                if mix_before:
+                    self.mix(mix_before[0], mix_before[1], step_source)
+                self.aspirate(step_volume / parts, step_source)
+                if touch_tip:
+                    self.touch_tip()
+                if air_gap:
+                    self.air_gap(air_gap)
+                self.dispense(step_volume / parts + air_gap, step_dest)
+                if mix_after:
+                    self.mix(mix_after[0], mix_after[1], step_dest)
+                if blow_out:
+                    if blowout_location == "source well":
+                        self.blow_out(step_source)
+                    elif blowout_location == "destination well":
+                        self.blow_out(step_dest)
+                    else:
+                        self.blow_out(Location(TRASH_POINT, None))
+                if new_tip == "always":
+                    self.drop_tip()
+
+        if new_tip == "once":
+            self.drop_tip()
+        return self
+
+
+class RecordingContext:
+
+    def __init__(self):
+        self.commands = []
+        self.max_speeds = MaxSpeeds(self)
+        self.labware = []
+        self._position = HOME_POINT
+        self._well = None
+        self._pipettes = []
+        self._taken = collections.defaultdict(float)
+
+    # Loading
+
+    def _add_labware(self, load_name, slot, label, z_offset=0.0, geometry=None):
+        labware = Labware(load_name, str(slot), label, z_offset, geometry)
+        self.labware.append(labware)
+        return labware
+
+    def load_labware(self, load_name, location, label=None, namespace=None, version=None):
+        return self._add_labware(load_name, location, label, geometry=labware_geometry(load_name, version))
+
+    def load_labware_from_definition(self, definition, location, label=None):
+        return self._add_labware(definition["parameters"]["loadName"], location, label,
+                                 geometry=definition_geometry(definition))
+
+    def load_module(self, name, location):
+        return Module(self, name, str(location))
+
+    def load_instrument(self, instrument_name, mount, tip_racks=None, replace=False):
+        pipette = Pipette(self, instrument_name, mount, tip_racks)
+        self._pipettes.append(pipette)
+        return pipette
+
+    # Protocol flow
+
+    def comment(self, msg):
+        self._record("comment", text=msg)
+
+    def pause(self, msg=None):
+        self._record("pause", text=msg)
+
+    def delay(self, seconds=0, minutes=0, msg=None):
+        self._record("delay", seconds=seconds + minutes * 60)
+
+    def home(self):
+        self._record("home", point=HOME_POINT)
+
+    def is_simulating(self):
+        return True
+
+    # Recording
+
+    def _record(self, name, location=None, point=None, **fields):
+        command = dict(fields)
+        command["command"] = name
+        command["z_speed"] = dict.get(self.max_speeds, "Z")
+
+        if location is not None and point is None:
+            point = location.point
+        if point is not None:
+            command["location"] = repr(location) if location is not None else None
+            command["xy"], command["z"] = self._travel(point, location)
+            command["speed"] = self._pipette_speed(fields.get("pipette"))
+            self._position = point
+            self._well = location.labware if location is not None else None
+
+        self.commands.append(command)
+
+    def _pipette_speed(self, mount):
+        for pipette in self._pipettes:
+            if pipette.mount == mount:
+                return pipette.default_speed
+        return 400.0
+
+    def _travel(self, point, location):
+        # XY distance and Z distance of the move to `point`, arcing over the labware unless
+        # the move stays inside the same well
+        x, y, z = self._position
+        xy = math.hypot(point[0] - x, point[1] - y)
+        same_well = location is not None and location.labware is self._well
+        if same_well or xy < 0.01:
+            return 0.0, abs(point[2] - z)
+        safe_z = max([labware.height for labware in self.labware] + [0.0]) + TRAVEL_CLEARANCE
+        safe_z = max(safe_z, z, point[2])
+        return xy, (safe_z - z) + (safe_z - point[2])
+
+    def _take(self, location, volume):
+        # Net volume taken out of every well, dispensing or blowing out into a well puts it back
+        if location is not None and isinstance(location.labware, Well):
+            self._taken[location.labware] += volume
+
+    def tips_used(self):
+        return sum(len(pipette._used_tips) for pipette in self._pipettes)
+
+    def reagents_used(self):
+        # Net ul taken from every reservoir well by "slot:well", e.g. {"7:A1": 12960.0}
+        return dict((well.parent.slot + ":" + well.well_name, volume) for well, volume in self._taken.items()
+                    if "reservoir" in well.parent.load_name and volume > 0)
+
+    def count(self, name):
+        return len([command for command in self.commands if command["command"] == name])
+
+
+def load_protocol(path):
+
+    # Import a protocol file as a module without running it
+    name = "protocol_" + os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def override_values(module, overrides):
+
+    # Replace the protocol's get_values() so `overrides` win over the values written in the file
+    get_values = module.get_values
+
+    def patched_get_values(*names):
+        return [overrides[name] if name in overrides else get_values(name)[0] for name in names]
+
+    module.get_values = patched_get_values
+    return module
+
+
+def run_protocol(path, overrides=None):
+
+    # Run the protocol at `path` against a fresh RecordingContext and return the context
+    module = load_protocol(path)
+    if overrides:
+        override_values(module, overrides)
+    context = RecordingContext()
+    module.run(context)
+    return context
@@ -0,0 +1,168 @@
+import argparse
+import ast
+import os
+import sys
+
+from recording_context import run_protocol
+
+
+# Offline runtime estimate for a protocol, broken down by phase.
+# The protocol's run() is recorded with RecordingContext and every command is given a cost:
+# delays count in full, liquid handling takes volume / flow rate, and every move takes its
+# XY distance at the pipette speed plus its Z distance at the Z speed limit in effect
+# (protocol_context.max_speeds['Z'] when the protocol sets it).
+#
+# Usage:
+#   python Simulation/runtime_estimator.py PCR_Clean_up/PCR_Purification_Omega_magbind_96wells.py
+#   python Simulation/runtime_estimator.py PCR_Clean_up/PCR_Purification_Omega_magbind_96wells.py --set sample_number=48
+#   python Simulation/runtime_estimator.py PCR_Clean_up/PCR_Purification_Omega_magbind_96wells.py --compare pipelined=True
+
+
+Z_SPEED = 125.0  # Default maximum Z speed of the OT-2 gantry, mm/s
+
+# Fixed cost of commands that do not depend on volume, in seconds
+COMMAND_SECONDS = {
+    "pick_up_tip": 3.0,
+    "return_tip": 2.5,
+    "drop_tip": 2.5,
+    "blow_out": 1.0,
+    "touch_tip": 2.0,
+    "engage": 5.0,
+    "disengage": 5.0,
+    "home": 10.0,
+}
+
+TEMPERATURE_RAMP = 0.2  # Temperature module gen2, degrees C per second
+ROOM_TEMPERATURE = 25.0
+
+# A comment containing the text on the left starts the phase on the right, a phase of None
+# names the phase after the comment itself (e.g. "Ethanol wash 2").
+# Commands before the first marker belong to "setup".
+PHASE_MARKERS = [
+    ("Adding magbeads and mixing", "bead add and mixing"),
+    ("Adding magbeads", "bead add"),
+    ("Mixing magbeads", "mixing"),
+    ("Mix and Incubate", "mixing"),
+    ("Incubating for", "incubation"),
+    ("Magnetic module turned on", "incubation"),
+    ("Binding plate", "binding"),
+    ("Removing supernatant", "supernatant removal"),
+    ("Ethanol wash", None),
+    ("Wash with 150ul", "ethanol wash"),
+    ("Air-drying", "drying"),
+    ("Add elution buffer", "elution"),
+    ("Turn on magnets", "output transfer"),
+    ("Adding water", "water"),
+    ("Transferring primers", "primer transfer"),
+]
+
+
+def command_seconds(command, temperatures, elapsed=0.0):
+
+    # Estimated duration of one recorded command that starts `elapsed` seconds into the run. `temperatures` holds
+    # the target of every module that was set and when it gets there, a started ramp goes on during later commands
+    name = command["command"]
+    seconds = COMMAND_SECONDS.get(name, 0.0)
+
+    if "xy" in command:
+        z_speed = min(command["z_speed"] or Z_SPEED, Z_SPEED)
+        seconds = seconds + command["xy"] / command["speed"] + command["z"] / z_speed
+
+    if name in ("aspirate", "dispense", "air_gap"):
+        seconds = seconds + command["volume"] / command["flow_rate"]
+    elif name == "mix":
+        seconds = seconds + command["repetitions"] * (command["volume"] / command["aspirate_rate"] +
+                                                      command["volume"] / command["dispense_rate"])
+    elif name == "delay":
+        seconds = seconds + command["seconds"]
+    elif name in ("set_temperature", "start_set_temperature", "await_temperature"):
+        current, ready = temperatures.get(command["module"], (ROOM_TEMPERATURE, 0.0))
+        ramp = max(ready - elapsed, 0.0) + abs(command["celsius"] - current) / TEMPERATURE_RAMP
+        temperatures[command["module"]] = (command["celsius"], elapsed + ramp)
+        if name != "start_set_temperature":
+            seconds = seconds + ramp
+    elif name == "deactivate":
+        temperatures.pop(command["module"], None)
+
+    return seconds
+
+
+def phase_for(command, phase):
+    if command["command"] == "comment":
+        for marker, marker_phase in PHASE_MARKERS:
+            if marker.lower() in command["text"].lower():
+                return marker_phase or command["text"].strip().lower()
+    return phase
+
+
+def estimate(commands):
+
+    # Returns a list of (phase, seconds) in the order the phases first ran, and the number of
+    # operator pauses, which are not part of the estimate
+    phases = []
+    seconds_by_phase = dict()
+    temperatures = dict()
+    phase = "setup"
+    pauses = 0
+    elapsed = 0.0
+
+    for command in commands:
+        phase = phase_for(command, phase)
+        if phase not in seconds_by_phase:
+            phases.append(phase)
+            seconds_by_phase[phase] = 0.0
+        seconds = command_seconds(command, temperatures, elapsed)
+        seconds_by_phase[phase] = seconds_by_phase[phase] + seconds
+        elapsed = elapsed + seconds
+        if command["command"] == "pause":
+            pauses = pauses + 1
+
+    return [(phase, seconds_by_phase[phase]) for phase in phases], pauses
+
+
+def parse_overrides(assignments):
+    overrides = dict()
+    for assignment in assignments or []:
+        name, value = assignment.split("=", 1)
+        try:
+            overrides[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            overrides[name] = value
+    return overrides
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Estimate the runtime of a protocol without the robot")
+    parser.add_argument("protocol", help="protocol file, e.g. PCR_Clean_up/PCR_Purification_Omega_magbind_96wells.py")
+    parser.add_argument("--set", action="append", metavar="NAME=VALUE",
+                        help="override a get_values() entry, can be given several times")
+    parser.add_argument("--compare", action="append", metavar="NAME=VALUE",
+                        help="estimate a second run with these overrides on top of --set and show both")
+    args = parser.parse_args(argv)
+
+    overrides = parse_overrides(args.set)
+    context = run_protocol(args.protocol, overrides)
+    phases, pauses = estimate(context.commands)
+    runs = [dict(phases)]
+    titles = ["minutes"]
+
+    if args.compare:
+        compare_overrides = dict(overrides)
+        compare_overrides.update(parse_overrides(args.compare))
+        compare_phases, compare_pauses = estimate(run_protocol(args.protocol, compare_overrides).commands)
+        runs.append(dict(compare_phases))
+        phases = phases + [(phase, seconds) for phase, seconds in compare_phases if phase not in runs[0]]
+        titles.append(" ".join(args.compare))
+
+    width = max(len(title) for title in titles) + 4
+    print("Estimated runtime of " + os.path.basename(args.protocol))
+    print("{:<28}".format("phase") + "".join(title.rjust(width) for title in titles))
+    for phase, seconds in phases:
+        print("{:<28}".format(phase) + "".join("{:.1f}".format(run.get(phase, 0.0) / 60).rjust(width) for run in runs))
+    print("{:<28}".format("total") + "".join("{:.1f}".format(sum(run.values()) / 60).rjust(width) for run in runs))
+    if pauses:
+        print(str(pauses) + " operator pause(s) not included")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
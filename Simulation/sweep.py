@@ -0,0 +1,129 @@
+import argparse
+import ast
+import collections
+import csv
+import itertools
+import multiprocessing
+import os
+import sys
+
+from recording_context import load_protocol, override_values, RecordingContext
+from runtime_estimator import estimate, parse_overrides
+
+
+# Parameter sweep of a protocol: every combination of the --grid values is simulated against
+# RecordingContext in a pool of worker processes, one per core by default. For every point the table
+# shows the estimated runtime, the tips used, the net volume taken from each reservoir well and the
+# command counts, so a few hundred settings of get_values() can be compared side by side.
+#
+# Usage:
+#   python Simulation/sweep.py PCR_Clean_up/PCR_Purification_Omega_magbind_96wells.py --grid bead_ratio=1.5,1.8,2.0 --grid mag_delay=4,6,8
+#   python Simulation/sweep.py PCR_Clean_up/PCR_Purification_Omega_magbind_96wells.py --grid zspeed=15,25,50 --set sample_number=48 --output sweep.csv
+
+
+# Commands counted in the table, the CSV has every recorded command kind
+REPORTED_COMMANDS = ["aspirate", "dispense", "mix", "pick_up_tip", "delay"]
+
+
+def parse_grid(assignments):
+
+    # "name=1,2,3" -> ("name", [1, 2, 3]). Values are Python literals, plain words are taken as strings.
+    grid = []
+    for assignment in assignments or []:
+        name, text = assignment.split("=", 1)
+        try:
+            values = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            values = tuple(text.split(","))
+        grid.append((name, list(values) if isinstance(values, tuple) else [values]))
+    return grid
+
+
+def points(grid, fixed):
+    # get_values() overrides of every combination of the grid, on top of the fixed overrides
+    names = [name for name, values in grid]
+    for combination in itertools.product(*[values for name, values in grid]):
+        overrides = dict(fixed)
+        overrides.update(zip(names, combination))
+        yield overrides
+
+
+def simulate(job):
+
+    # Run one point in a worker process. The protocol is loaded again for every point, so the
+    # get_values() override of one point does not leak into the next.
+    path, overrides = job
+    context = RecordingContext()
+    status = "ok"
+    try:
+        module = override_values(load_protocol(path), overrides)
+        module.run(context)
+    except Exception as error:
+        status = type(error).__name__ + ": " + str(error)
+
+    phases, pauses = estimate(context.commands)
+    return {
+        "overrides": overrides,
+        "status": status,
+        "estimated_seconds": sum(seconds for phase, seconds in phases),
+        "tips": context.tips_used(),
+        "reagents": context.reagents_used(),
+        "commands": dict(collections.Counter(command["command"] for command in context.commands)),
+    }
+
+
+def sweep(path, grid, fixed=None, jobs=None):
+    work = [(path, overrides) for overrides in points(grid, fixed or {})]
+    with multiprocessing.Pool(jobs) as pool:
+        return pool.map(simulate, work, chunksize=max(1, len(work) // (4 * (jobs or os.cpu_count() or 1))))
+
+
+def write_table(filename, results, names):
+
+    # One CSV row per point: the swept values, runtime, tips, reagents in ul and all command counts
+    reagents = sorted(set(well for result in results for well in result["reagents"]))
+    commands = sorted(set(command for result in results for command in result["commands"]))
+    with open(filename, "w", newline="") as table_file:
+        writer = csv.writer(table_file)
+        writer.writerow(names + ["status", "estimated_minutes", "tips"] + ["ul from " + well for well in reagents] + commands)
+        for result in results:
+            writer.writerow([result["overrides"][name] for name in names] +
+                            [result["status"], round(result["estimated_seconds"] / 60, 2), result["tips"]] +
+                            [round(result["reagents"].get(well, 0.0), 1) for well in reagents] +
+                            [result["commands"].get(command, 0) for command in commands])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a protocol over a grid of get_values() overrides in parallel")
+    parser.add_argument("protocol", help="protocol file, e.g. PCR_Clean_up/PCR_Purification_Omega_magbind_96wells.py")
+    parser.add_argument("--grid", action="append", metavar="NAME=V1,V2,...", required=True,
+                        help="values to sweep for one get_values() entry, can be given several times")
+    parser.add_argument("--set", action="append", metavar="NAME=VALUE",
+                        help="override a get_values() entry at every point, can be given several times")
+    parser.add_argument("--jobs", type=int, help="worker processes, defaults to the number of cores")
+    parser.add_argument("--output", default="sweep_results.csv", help="CSV file the table is written to")
+    args = parser.parse_args(argv)
+
+    grid = parse_grid(args.grid)
+    names = [name for name, values in grid]
+    results = sweep(args.protocol, grid, parse_overrides(args.set), args.jobs)
+    write_table(args.output, results, names)
+
+    width = max([len(name) for name in names] + [8]) + 2
+    reagents = sorted(set(well for result in results for well in result["reagents"]))
+    print("{} points of {}".format(len(results), os.path.basename(args.protocol)))
+    print("".join(name.rjust(width) for name in names) + "{:>9}{:>6}".format("est min", "tips") +
+          "".join(("ml " + well).rjust(10) for well in reagents) + "".join(name.rjust(12) for name in REPORTED_COMMANDS))
+    for result in sorted(results, key=lambda result: (result["status"] != "ok", result["estimated_seconds"])):
+        line = ("".join(str(result["overrides"][name]).rjust(width) for name in names) +
+                "{:>9.1f}{:>6}".format(result["estimated_seconds"] / 60, result["tips"]) +
+                "".join("{:.1f}".format(result["reagents"].get(well, 0.0) / 1000).rjust(10) for well in reagents) +
+                "".join(str(result["commands"].get(command, 0)).rjust(12) for command in REPORTED_COMMANDS))
+        print(line)
+        if result["status"] != "ok":
+            print("    " + result["status"])
+    print("Results written to " + args.output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
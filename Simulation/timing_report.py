@@ -0,0 +1,90 @@
+import argparse
+import collections
+import json
+import os
+import sys
+
+from recording_context import run_protocol
+from runtime_estimator import estimate, parse_overrides
+
+
+# Per-phase timing of a real run from the JSON lines timing log the protocols write to
+# /data/user_storage/timing_log.jsonl, optionally next to the offline estimate of the same protocol.
+# "measured" is the wall-clock time of the phase, "handling" the part of it spent in pipette calls;
+# the difference is waiting: delays, module moves and temperature changes.
+#
+# Usage (copy the log from the robot first, e.g. with scp):
+#   python Simulation/timing_report.py timing_log.jsonl
+#   python Simulation/timing_report.py timing_log.jsonl --protocol PCR_Clean_up/PCR_Purification_Omega_magbind_96wells.py --set sample_number=48
+
+
+def read_log(filename):
+    with open(filename) as log_file:
+        return [json.loads(line) for line in log_file if line.strip()]
+
+
+def summarize(events):
+
+    # Returns a list of (phase, measured seconds, handling seconds, pipette calls) in the order the phases ran
+    phases = []
+    measured = collections.defaultdict(float)
+    handling = collections.defaultdict(float)
+    calls = collections.Counter()
+
+    for event in events:
+        phase = event["phase"]
+        if phase not in phases:
+            phases.append(phase)
+        if event["event"] == "phase":
+            measured[phase] = measured[phase] + event["end"] - event["start"]
+        else:
+            handling[phase] = handling[phase] + event["end"] - event["start"]
+            calls[phase] = calls[phase] + 1
+
+    return [(phase, measured[phase], handling[phase], calls[phase]) for phase in phases]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-phase timing of a protocol run from its timing log")
+    parser.add_argument("log", help="timing log, e.g. a copy of /data/user_storage/timing_log.jsonl")
+    parser.add_argument("--run", help="run to report, e.g. 20240131-093000, defaults to the last run in the log")
+    parser.add_argument("--protocol", help="protocol file to estimate the same phases for")
+    parser.add_argument("--set", action="append", metavar="NAME=VALUE",
+                        help="override a get_values() entry for the estimate, can be given several times")
+    args = parser.parse_args(argv)
+
+    events = read_log(args.log)
+    runs = []
+    for event in events:
+        if event["run"] not in runs:
+            runs.append(event["run"])
+    if not runs:
+        print("No events in " + args.log)
+        return 1
+    run = args.run or runs[-1]
+    phases = summarize([event for event in events if event["run"] == run])
+
+    estimated = dict()
+    if args.protocol:
+        estimated = dict(estimate(run_protocol(args.protocol, parse_overrides(args.set)).commands)[0])
+
+    print("Run " + run + " from " + os.path.basename(args.log) + " (" + str(len(runs)) + " run(s) in the log)")
+    print("{:<24}{:>10}{:>10}{:>8}".format("phase", "measured", "handling", "calls") +
+          ("{:>11}{:>9}".format("estimated", "diff") if args.protocol else ""))
+    for phase, measured, handling, calls in phases:
+        line = "{:<24}{:>10.1f}{:>10.1f}{:>8}".format(phase, measured / 60, handling / 60, calls)
+        if args.protocol and phase in estimated:
+            line = line + "{:>11.1f}{:>+9.1f}".format(estimated[phase] / 60, (measured - estimated[phase]) / 60)
+        print(line)
+
+    total = sum(measured for phase, measured, handling, calls in phases if phase != "operator pause")
+    line = "{:<24}{:>10.1f}{:>10.1f}{:>8}".format("total without pauses", total / 60,
+                                                   sum(phase[2] for phase in phases) / 60, sum(phase[3] for phase in phases))
+    if args.protocol:
+        line = line + "{:>11.1f}{:>+9.1f}".format(sum(estimated.values()) / 60, (total - sum(estimated.values())) / 60)
+    print(line)
+    print("Times in minutes")
+
+
+if __name__ == "__main__":
+    sys.exit(main())